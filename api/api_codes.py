@@ -52,7 +52,8 @@ class RequestCodes():
             "field_size_x": int,
             "field_size_y": int,
             "mine_prob": float,
-            "max_players": int
+            "max_players": int,
+            "lockstep": bool  << if true, the room sends INGAME_INPUT_BROADCAST instead of deltas
         } // api_datatypes.RoomCreationParameters
     response: (JSON)
         {
@@ -103,11 +104,17 @@ class RequestCodes():
     Client -> Server
     request: (JSON)
         {
-            "player_id":int
+            "player_id":int,
+            "version":int,  << optional
+            "state_hash":int  << optional
         }
     response:(NONE)
     // This is a special request, telling the server to send a NewState frame
     // even if there's no change.
+    // If the client sends the version and state_hash() of its current state, the server replies with
+    //   INGAME_NEWSTATE_IN_SYNC, if the client is up to date
+    //   INGAME_NEWSTATE_DELTA_AND_ACK, if the client has one of the server's recent states
+    //   INGAME_NEWSTATE_AND_ACK otherwise
     '''
 
     #INGAME_NEWSTATE = 110
@@ -131,12 +138,77 @@ class RequestCodes():
                 "button": int,
                 "player_index": int
                 "input_id": int,
-                "room_id":int
-            } // api_datatypes.RoomMFI
+                "room_id":int,
+                "version":int
+            } // api_datatypes.RoomMFI, plus the version of the state
+        [n] NUL byte (\0)
+        [n+1... (BINARY)
+            // compact snapshot (see common.snapshot)
+            // common.packed_mines.PackedMineFieldState .to_compact_bytes() .from_compact_bytes()
+    response: (NONE)
+    // Every state of a room has a version, counting up by one for each input.
+    // Full states are only sent when requested by INGAME_EXPLICIT_NEWSTATE_REQUEST.
+    '''
+
+    INGAME_NEWSTATE_DELTA_AND_ACK=114
+    '''
+    INGAME_NEWSTATE_DELTA_AND_ACK
+    Server -> Client
+    request: (COMPLEX)
+        [0...n) (JSON)
+            {
+                "x": int,
+                "y": int,
+                "button": int,
+                "player_index": int
+                "input_id": int,
+                "room_id":int,
+                "base_version":int,
+                "version":int
+            } // api_datatypes.RoomMFI, plus the versions of the states before and after the input
         [n] NUL byte (\0)
         [n+1... (BINARY)
-            // common.mines.MineFieldState .to_bytes() .from_bytes()
+            // patch: the cells that changed (see common.snapshot.encode_patch)
+            // common.packed_mines.PackedMineFieldState .cell_bytes() .apply_patch()
+    response: (NONE)
+    // Sent for every input. A client whose state is not at base_version
+    // must ask for the full state with INGAME_EXPLICIT_NEWSTATE_REQUEST.
+    '''
+
+    INGAME_NEWSTATE_IN_SYNC=116
+    '''
+    INGAME_NEWSTATE_IN_SYNC
+    Server -> Client
+    request: (JSON)
+        {
+            "room_id":int,
+            "version":int
+        }
+    response: (NONE)
+    // Reply to INGAME_EXPLICIT_NEWSTATE_REQUEST: the client's state is already the server's.
+    '''
+
+    INGAME_INPUT_BROADCAST=115
+    '''
+    INGAME_INPUT_BROADCAST
+    Server -> Client
+    request: (JSON)
+        {
+            "x": int,
+            "y": int,
+            "button": int,
+            "player_index": int
+            "input_id": int,
+            "room_id":int,
+            "version":int,
+            "state_hash":int  << only every few inputs
+        } // api_datatypes.RoomMFI, plus the version of the state after the input
     response: (NONE)
+    // Lockstep rooms send this instead of INGAME_NEWSTATE_DELTA_AND_ACK.
+    // Every client applies the input to its own state (version-1) to get the new one.
+    // When state_hash is present, it must match the new state's state_hash();
+    // if it does not, or the version does not follow, the client asks for the full state
+    // with INGAME_EXPLICIT_NEWSTATE_REQUEST.
     '''
 
     INGAME_NOTIFY_ROOM_PARAM_CHANGED=130
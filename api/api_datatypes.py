@@ -5,7 +5,10 @@ def namedtuple_to_dict(nt):
     return nt._asdict()
 
 def dict_to_namedtuple(d,nt_class):
-    return nt_class(*[ d[field] for field in nt_class._fields])
+    # Fields with a default may be missing (e.g. sent by an older client)
+    defaults=nt_class._field_defaults
+    return nt_class(*[ d[field] if field in d or field not in defaults else defaults[field]
+                       for field in nt_class._fields])
 
 GameRoomData = collections.namedtuple("GameRoomData",
                                   ("name",
@@ -20,7 +23,9 @@ RoomCreationParameters = collections.namedtuple("RoomCreationParameters",
                                                 "field_size_x",
                                                 "field_size_y",
                                                 "mine_prob",
-                                                "max_players"))
+                                                "max_players",
+                                                "lockstep"),
+                                                defaults=(False,))
 
 InGameRoomParameters = collections.namedtuple("InGameRoomParameters",
                                               ("player_index_mapping",
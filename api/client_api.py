@@ -4,7 +4,8 @@ import json
 from api.api_codes import RequestCodes
 from util.utils import json_bytes_to_object, object_to_json_bytes, restore_int_keys
 from api import api_datatypes
-import common.mines
+import common.packed_mines
+from common import snapshot
 import tkinter
 
 import collections
@@ -24,6 +25,24 @@ class ClientSideAPI():
         )
         self._handler_ingame_newstateACK=None
 
+        self._sp.set_handler(
+            self._base_handler_ingame_newstate_delta,
+            RequestCodes.INGAME_NEWSTATE_DELTA_AND_ACK
+        )
+        self._handler_ingame_newstate_delta=None
+
+        self._sp.set_handler(
+            self._base_handler_ingame_input_broadcast,
+            RequestCodes.INGAME_INPUT_BROADCAST
+        )
+        self._handler_ingame_input_broadcast=None
+
+        self._sp.set_handler(
+            self._base_handler_ingame_newstate_in_sync,
+            RequestCodes.INGAME_NEWSTATE_IN_SYNC
+        )
+        self._handler_ingame_newstate_in_sync=None
+
         self._sp.set_handler(
             self._base_handler_ingame_room_param_changed,
             RequestCodes.INGAME_NOTIFY_ROOM_PARAM_CHANGED
@@ -33,6 +52,10 @@ class ClientSideAPI():
     def kill_connection(self):
         self._sp.kill_pipe()
 
+    @property
+    def player_id(self):
+        return self._player_id
+
     def login(self, username, cb_success, cb_fail):
         '''
         Log in to the server and get a player_id
@@ -161,19 +184,66 @@ class ClientSideAPI():
         '''
         self._handler_ingame_newstateACK=handler
 
+    @classmethod
+    def _split_json_and_binary(cls, data):
+        nul_place=data.index(0) # the single NUL
+        return json_bytes_to_object(data[:nul_place]), data[(nul_place+1):]
+
     def _base_handler_ingame_newstateACK(self,data):
-        nul_place=0
-        for i in range(len(data)):
-            if data[i]==0: # the single NUL
-                nul_place=i
-                break
-        part1_json=data[:nul_place]
-        part2_binary=data[(nul_place+1):]
-        j=json_bytes_to_object(part1_json)
+        j,part2_binary=self._split_json_and_binary(data)
         rmfi=api_datatypes.dict_to_namedtuple(j,api_datatypes.RoomMFI)
-        mfs=common.mines.MineFieldState.from_bytes(part2_binary)
+        mfs=common.packed_mines.PackedMineFieldState.from_compact_bytes(part2_binary, j["version"])
         self._handler_ingame_newstateACK(rmfi, mfs)
 
+    def set_handler_ingame_newstate_delta(self, handler):
+        '''
+        set handler for the INGAME_NEWSTATE_DELTA_AND_ACK event
+
+        handler function signature:
+            handler(rmfi, base_version, version, indices, cells)
+                rmfi: the RoomMFI object of the input that caused this update.
+                base_version: the version of the state the patch applies to
+                version: the version of the state after the patch
+                indices, cells: the patch. (see PackedMineFieldState.apply_patch)
+        '''
+        self._handler_ingame_newstate_delta=handler
+
+    def _base_handler_ingame_newstate_delta(self,data):
+        j,part2_binary=self._split_json_and_binary(data)
+        rmfi=api_datatypes.dict_to_namedtuple(j,api_datatypes.RoomMFI)
+        indices,cells=snapshot.decode_patch(part2_binary)
+        self._handler_ingame_newstate_delta(rmfi, j["base_version"], j["version"], indices, cells)
+
+    def set_handler_ingame_input_broadcast(self, handler):
+        '''
+        set handler for the INGAME_INPUT_BROADCAST event (lockstep rooms)
+
+        handler function signature:
+            handler(rmfi, version, state_hash)
+                rmfi: the RoomMFI object of the input
+                version: the version of the state after the input
+                state_hash: the state_hash() of the state after the input, or None if not sent
+        '''
+        self._handler_ingame_input_broadcast=handler
+
+    def _base_handler_ingame_input_broadcast(self,data):
+        j=json_bytes_to_object(data)
+        rmfi=api_datatypes.dict_to_namedtuple(j,api_datatypes.RoomMFI)
+        self._handler_ingame_input_broadcast(rmfi, j["version"], j.get("state_hash"))
+
+    def set_handler_ingame_newstate_in_sync(self, handler):
+        '''
+        set handler for the INGAME_NEWSTATE_IN_SYNC event
+
+        handler function signature:
+            handler(room_id, version)
+        '''
+        self._handler_ingame_newstate_in_sync=handler
+
+    def _base_handler_ingame_newstate_in_sync(self,data):
+        j=json_bytes_to_object(data)
+        self._handler_ingame_newstate_in_sync(j["room_id"], j["version"])
+
     def set_handler_ingame_room_param_changed(self,handler):
         '''
         handler is given the room id. No returns nessasary.
@@ -217,15 +287,19 @@ class ClientSideAPI():
             callback
         )
 
-    def ingame_explicit_newstate_request(self, player_id):
+    def ingame_explicit_newstate_request(self, player_id, mfs=None):
         '''
         Request a newstate update to the server. No callbacks.
         player_id must be provided.
+        mfs: the client's current state, if any.
+             Its version and hash are sent, so the server can reply with less than a full state.
         '''
+        d={"player_id":player_id}
+        if mfs is not None:
+            d["version"]=mfs.version
+            d["state_hash"]=mfs.state_hash()
         self._sp.send_request(
-            object_to_json_bytes({
-                "player_id":player_id
-            }),
+            object_to_json_bytes(d),
             RequestCodes.INGAME_EXPLICIT_NEWSTATE_REQUEST,
             None
         )
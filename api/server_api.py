@@ -2,7 +2,8 @@ from network import smart_pipe
 from api.api_codes import RequestCodes
 import json
 from api import api_datatypes
-import common.mines
+import common.packed_mines
+from common import snapshot
 from util.utils import json_bytes_to_object, object_to_json_bytes
 
 class InvalidRequestException(Exception):
@@ -179,16 +180,67 @@ class ServerSideAPI:
         self._handler_ingame_input(rmfi)
 
 
-    def send_newstateACK(self, rmfi:api_datatypes.RoomMFI, mfs:common.mines.MineFieldState):
-        res=bytes()
-        res += object_to_json_bytes(api_datatypes.namedtuple_to_dict(rmfi))
-        res+= bytes((0,))
-        res += common.mines.MineFieldState.to_bytes(mfs)
+    def send_newstateACK(self, rmfi:api_datatypes.RoomMFI, mfs:common.packed_mines.PackedMineFieldState):
+        self._sp.send_packed(self.pack_newstateACK(rmfi, mfs))
+
+    @classmethod
+    def pack_newstateACK(cls, rmfi:api_datatypes.RoomMFI, mfs:common.packed_mines.PackedMineFieldState):
+        '''
+        Encode a NEWSTATE_AND_ACK into a complete frame, once.
+        The result can be sent to any number of players with send_packed().
+        '''
+        j=api_datatypes.namedtuple_to_dict(rmfi)
+        j["version"]=mfs.version
+        res=b"".join((
+            object_to_json_bytes(j),
+            bytes((0,)),
+            type(mfs).to_compact_bytes(mfs, snapshot.COMPRESSION_ZLIB) # Packed or tiled, both use the same format
+        ))
+        return smart_pipe.SmartPipe.pack_broadcast(res, RequestCodes.INGAME_NEWSTATE_AND_ACK)
+
+    @classmethod
+    def pack_newstate_delta(cls, rmfi:api_datatypes.RoomMFI, base_version, version, indices, cells):
+        '''
+        Encode a NEWSTATE_DELTA_AND_ACK into a complete frame, once.
+        indices, cells: the flat indices of the changed cells, and their new packed cell bytes
+        '''
+        j=api_datatypes.namedtuple_to_dict(rmfi)
+        j["base_version"]=base_version
+        j["version"]=version
+        res=b"".join((
+            object_to_json_bytes(j),
+            bytes((0,)),
+            snapshot.encode_patch(indices, cells)
+        ))
+        return smart_pipe.SmartPipe.pack_broadcast(res, RequestCodes.INGAME_NEWSTATE_DELTA_AND_ACK)
+
+    def send_newstate_delta(self, rmfi:api_datatypes.RoomMFI, base_version, version, indices, cells):
+        self._sp.send_packed(self.pack_newstate_delta(rmfi, base_version, version, indices, cells))
+
+    def send_in_sync(self, room_id, version):
         self._sp.send_request(
-            res,
-            RequestCodes.INGAME_NEWSTATE_AND_ACK,
-            None # no callback
+            object_to_json_bytes({"room_id":room_id, "version":version}),
+            RequestCodes.INGAME_NEWSTATE_IN_SYNC,
+            None
         )
+
+    @classmethod
+    def pack_input_broadcast(cls, rmfi:api_datatypes.RoomMFI, version, state_hash=None):
+        '''
+        Encode an INGAME_INPUT_BROADCAST into a complete frame, once.
+        state_hash: the state_hash() of the state after the input, or None to leave it out
+        '''
+        j=api_datatypes.namedtuple_to_dict(rmfi)
+        j["version"]=version
+        if state_hash is not None:
+            j["state_hash"]=state_hash
+        return smart_pipe.SmartPipe.pack_broadcast(object_to_json_bytes(j), RequestCodes.INGAME_INPUT_BROADCAST)
+
+    def send_packed(self, frame):
+        '''
+        Send a frame packed by one of the pack_ methods.
+        '''
+        self._sp.send_packed(frame)
     def send_notification_room_param_changed(self,room_id):
         self._sp.send_request(
             object_to_json_bytes({"room_id":room_id}),
@@ -223,14 +275,15 @@ class ServerSideAPI:
 
     def set_handler_explicit_newstate_request(self,handler):
         '''
-        Argument: player_id
+        Arguments: player_id, version, state_hash
+            version, state_hash: of the client's current state. None if it did not send them.
         returns: none
         '''
         self._handler_explicit_newstate_request=handler
 
     def _raw_handle_explicit_newstate_request(self,data):
-        player_id=json_bytes_to_object(data)["player_id"]
-        self._handler_explicit_newstate_request(player_id)
+        d=json_bytes_to_object(data)
+        self._handler_explicit_newstate_request(d["player_id"], d.get("version"), d.get("state_hash"))
 
     def set_handler_leave_room(self, handler):
         '''
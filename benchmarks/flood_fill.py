@@ -0,0 +1,91 @@
+'''
+Flood fill benchmark.
+
+Compares the original list-based MineFieldState._uncover
+(kept here as _legacy_uncover, since it no longer exists in common.mines)
+with the current MineFieldState and PackedMineFieldState implementations,
+by opening a completely empty field with a single click.
+
+Run from the repository root:
+    python3 -m benchmarks.flood_fill [size [size ...]]
+'''
+import sys
+import time
+
+from common import mines
+from common import packed_mines
+from util import multiarray
+from util.utils import Tuples
+
+
+def _legacy_uncover(data, initial_coords, player_index):
+    '''
+    MineFieldState._uncover, as it was before the flood fill got linear.
+    pop(0) and the "in uncover_queue" check make this quadratic.
+    '''
+    uncover_queue = []
+    uncover_queue.append(initial_coords)
+
+    while uncover_queue:
+        coords = uncover_queue.pop(0)
+        cell = data[coords]
+        if cell.can_click_by(player_index):
+            data[coords] = data[coords].modify(state=mines.CellState.clicked,
+                                               owner=player_index)
+
+            autoclick = (cell.number == 0) and (not cell.is_mine)
+
+            for delta in mines._neighbor_deltas:
+                newcoords = Tuples.add(coords, delta)
+                if not data.in_bounds(newcoords):
+                    continue
+
+                if data[newcoords].state == mines.CellState.locked:
+                    data[newcoords] = data[newcoords].modify(state=mines.CellState.clickable,
+                                                             owner=player_index)
+
+                if newcoords in uncover_queue:
+                    continue  # no duplicates
+                if autoclick:
+                    uncover_queue.append(newcoords)
+
+
+def _legacy_process_click(mfs, coords, player_index):
+    newdata = mfs._data.shallow_copy()
+    _legacy_uncover(newdata, coords, player_index)
+    return mines.MineFieldState(newdata)
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def run(size):
+    minemap = multiarray.MultiDimArray(size, size, fill=False)
+    mfs = mines.MineFieldGenerator.generate_from_minemap(minemap, 2)
+    pmfs = packed_mines.PackedMineFieldState.from_minefield(mfs)
+    mfi = mines.MineFieldInput(x=0, y=0, button=1, player_index=1)
+
+    legacy, t_legacy = _timed(lambda: _legacy_process_click(mfs, (0, 0), 1))
+    current, t_current = _timed(lambda: mfs.process_input(mfi))
+    packed, t_packed = _timed(lambda: pmfs.process_input(mfi))
+
+    expected = mines.MineFieldState.to_bytes(legacy)
+    if (mines.MineFieldState.to_bytes(current) != expected
+            or packed_mines.PackedMineFieldState.to_bytes(packed) != expected):
+        raise Exception("Flood fill results differ on a {0}x{0} field!".format(size))
+
+    print("{0:>4}x{0:<4} legacy {1:9.3f}s   MineFieldState {2:9.3f}s   PackedMineFieldState {3:9.3f}s".format(
+        size, t_legacy, t_current, t_packed))
+
+
+def main():
+    sizes = [int(i) for i in sys.argv[1:]] or [50, 100, 150, 200]
+    for size in sizes:
+        run(size)
+
+
+if __name__ == "__main__":
+    main()
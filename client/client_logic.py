@@ -1,5 +1,6 @@
 from util import utils
 from common import mines
+from common import packed_mines
 from api import api_datatypes
 from api import client_api
 
@@ -27,6 +28,10 @@ class ClientInGameLogic():
 
         self._event_stack= mines.MineFieldEventStack()
 
+        # Deltas from the server only apply to the base state with their base version.
+        # When they don't, the whole state is requested again.
+        self._resync_pending=False
+
         self._current_input_index=0
 
         self._player_index=player_index
@@ -37,6 +42,9 @@ class ClientInGameLogic():
         self._room_update_callbacks=[]
 
         client_api.set_handler_ingame_newstateACK(self.handler_newstateACK)
+        client_api.set_handler_ingame_newstate_delta(self.handler_newstate_delta)
+        client_api.set_handler_ingame_input_broadcast(self.handler_input_broadcast)
+        client_api.set_handler_ingame_newstate_in_sync(self.handler_newstate_in_sync)
         client_api.set_handler_ingame_room_param_changed(self.handler_room_param_change)
 
     def handler_room_param_change(self,rid):
@@ -96,7 +104,7 @@ class ClientInGameLogic():
         self._capi.ingame_input(rmfi)
 
 
-    def handler_newstateACK(self, rmfi:api_datatypes.RoomMFI, mfs:mines.MineFieldState):
+    def handler_newstateACK(self, rmfi:api_datatypes.RoomMFI, mfs:packed_mines.PackedMineFieldState):
         if (rmfi.roomID != self._room_id):
             raise Exception("what???????")
 
@@ -104,10 +112,67 @@ class ClientInGameLogic():
             # this ACK was directed at me!
             self._event_stack.ack_until(rmfi.inputID)
 
+        self._resync_pending=False
         self._event_stack.set_base_state(mfs)
         self._invalidate_cache()
         self._call_field_update_callbacks()
 
+    def handler_newstate_delta(self, rmfi:api_datatypes.RoomMFI, base_version, version, indices, cells):
+        if (rmfi.roomID != self._room_id):
+            raise Exception("what???????")
+
+        if (rmfi.player_index==self._player_index):
+            # this ACK was directed at me!
+            self._event_stack.ack_until(rmfi.inputID)
+
+        base=self._event_stack.base_state
+        if base is None or base_version != base.version:
+            # We missed something (or haven't got anything yet)
+            self._resync()
+            return
+
+        self._resync_pending=False
+        self._event_stack.set_base_state(base.apply_patch(indices, cells, version))
+        self._invalidate_cache()
+        self._call_field_update_callbacks()
+
+    def handler_input_broadcast(self, rmfi:api_datatypes.RoomMFI, version, state_hash):
+        if (rmfi.roomID != self._room_id):
+            raise Exception("what???????")
+
+        if (rmfi.player_index==self._player_index):
+            # this ACK was directed at me!
+            self._event_stack.ack_until(rmfi.inputID)
+
+        base=self._event_stack.base_state
+        if base is None or version-1 != base.version:
+            self._resync()
+            return
+
+        # Lockstep - run the input ourselves, exactly like the server did
+        newbase=base.process_input(api_datatypes.mfi_extract(rmfi))
+        if state_hash is not None and newbase.state_hash() != state_hash:
+            # Diverged from the server
+            self._resync()
+            return
+
+        self._event_stack.set_base_state(newbase)
+        self._invalidate_cache()
+        self._call_field_update_callbacks()
+
+    def handler_newstate_in_sync(self, room_id, version):
+        if room_id == self._room_id:
+            self._resync_pending=False
+
+    def _resync(self):
+        # Ask for the state again, once. Until it arrives, the base state is left alone.
+        # Our state's hash is sent along, so the server only sends what we are missing.
+        if not self._resync_pending:
+            self._resync_pending=True
+            self._capi.ingame_explicit_newstate_request(self._capi.player_id, self._event_stack.base_state)
+        self._invalidate_cache()
+        self._call_field_update_callbacks()
+
 
 
     def get_state(self):
@@ -319,8 +319,16 @@ def _display_room_creation(clicon:client_api.ClientSideAPI, success_cb):
     mineprob_slider_disp.grid(row=1,column=2)
     mineprob_slider.grid(row=4,column=2)
 
+    lockstep_label=tkinter.Label(root,text="Lockstep")
+    lockstep_label.grid(row=5,column=1)
+
+    lockstep_checkbox_VAR=tkinter.BooleanVar()
+    lockstep_checkbox_VAR.set(False)
+    lockstep_checkbox=tkinter.Checkbutton(root,variable=lockstep_checkbox_VAR)
+    lockstep_checkbox.grid(row=5,column=2)
+
     create_btn=tkinter.Button(root,text="Create")
-    create_btn.grid(row=5,column=1,columnspan=2)
+    create_btn.grid(row=6,column=1,columnspan=2)
 
 
     def create_success(room_id):
@@ -337,7 +345,8 @@ def _display_room_creation(clicon:client_api.ClientSideAPI, success_cb):
             name=name_input_VAR.get(),
             field_size_x=int(fieldsize_spinbox_x_VAR.get()),
             field_size_y=int(fieldsize_spinbox_y_VAR.get()),
-            mine_prob=mineprob_slider_get()
+            mine_prob=mineprob_slider_get(),
+            lockstep=lockstep_checkbox_VAR.get()
         )
         clicon.create_game(grp, create_success, create_fail)
     create_btn.configure(command=send_create_req)
@@ -251,9 +251,7 @@ class MineDisplay3(tkinter.Frame):
             self._set_dimensions(*(new_state.dimensions))
             cells_to_update=list(new_state.indices()) # every cell
         else:
-            for coords in old_state:
-                if old_state[coords] != new_state[coords]:
-                    cells_to_update.append(coords)
+            cells_to_update=[new_state.index_to_coords(i) for i in new_state.changed_indices(old_state)]
 
 
         for coords in cells_to_update:
@@ -26,25 +26,31 @@ class ImmutableCell():
              for clickable cells, this is the player index that can click the cell.
     is_mine: is this a mine?
     number:  Number of adjacent mines
+
+    There are only 4*8*2*9=576 valid cells, so every one of them is created once
+    when this module is loaded and then shared. (flyweight)
+    ImmutableCell(...), modify(), from_cell() and from_bytes() all return one of those shared instances,
+    which means two cells are equal if and only if they are the same object.
     '''
-    def __init__(self, state, owner, is_mine, number):
-        self._state=state
-        self._owner=owner
-        self._is_mine=is_mine
-        self._number=number
+    __slots__ = ("_state", "_owner", "_is_mine", "_number", "_packed", "_bytes")
 
-        if not self._check_attribute_types():
-            raise Exception("Invalid cell! "+str(self))
+    # All valid cells, indexed by (number << 6 | first byte of to_bytes())
+    # Filled in by _build_intern_table()
+    _interned = ()
 
+    def __new__(cls, state, owner, is_mine, number):
+        if not cls._check_attribute_types(state, owner, is_mine, number):
+            raise Exception("Invalid cell! ImmutableCell({},{},{},{})".format(state, owner, is_mine, number))
+        return cls._interned[cls._table_index(state, owner, is_mine, number)]
 
     def __eq__(self, other):
-        return ((self._state == other._state) and
-                (self._owner == other._owner) and
-                (self._is_mine == other._is_mine) and
-                (self._number == other._number))
+        return self is other
 
     def __ne__(self,other):
-        return not self.__eq__(other)
+        return self is not other
+
+    def __hash__(self):
+        return self._table_index(self._state, self._owner, self._is_mine, self._number)
 
     def __repr__(self):
         return "ImmutableCell({},{},{},{})".format(self.state,self.owner,self.is_mine,self.number)
@@ -74,6 +80,8 @@ class ImmutableCell():
 
     @classmethod
     def from_cell(cls,cell):
+        if type(cell) is ImmutableCell:
+            return cell
         return ImmutableCell(
             state=cell.state,
             owner=cell.owner,
@@ -81,42 +89,59 @@ class ImmutableCell():
             number=cell.number
         )
 
-    def _check_attribute_types(self):
-        if (type(self.state)==int
-            and (0<=self.state<=3)
-            and type(self.owner)==int
-            and (0<=self.owner<=7)
-            and type(self.is_mine) == bool
-            and type(self._number)==int
-            and 0<=self.number<=8):
+    @staticmethod
+    def _check_attribute_types(state, owner, is_mine, number):
+        if (type(state)==int
+            and (0<=state<=3)
+            and type(owner)==int
+            and (0<=owner<=7)
+            and type(is_mine) == bool
+            and type(number)==int
+            and 0<=number<=8):
             return True
         return False
 
-    def to_bytes(self):
-        byte1=0
-        byte1 |= self.state # bits 0,1
-        byte1 |= self.owner << 2 # bits 2,3,4
-        byte1 |= self.is_mine << 5 # bit 5
+    @staticmethod
+    def _table_index(state, owner, is_mine, number):
+        return (number << 6) | (is_mine << 5) | (owner << 2) | state
 
-        byte2=self.number # bits 0,1,2,3
+    @classmethod
+    def _build_intern_table(cls):
+        table = [None] * (9 << 6)
+        for number in range(9):
+            for is_mine in (False, True):
+                for owner in range(8):
+                    for state in range(4):
+                        cell = object.__new__(cls)
+                        cell._state = state
+                        cell._owner = owner
+                        cell._is_mine = is_mine
+                        cell._number = number
+                        cell._packed = state | (owner << 2) | (is_mine << 5)
+                        cell._bytes = bytes((cell._packed, number))
+                        table[cls._table_index(state, owner, is_mine, number)] = cell
+        cls._interned = tuple(table)
 
-        return bytes((byte1,byte2))
+    def to_bytes(self):
+        # byte1: state = bits 0,1 / owner = bits 2,3,4 / is_mine = bit 5
+        # byte2: number = bits 0,1,2,3
+        return self._bytes
 
     @classmethod
     def from_bytes(cls, b):
-        byte1=b[0]
-        byte2=b[1]
-        state = byte1 & 3
-        owner = (byte1 >> 2) & 7
-        is_mine = ((byte1>>5) & 1) != 0
-        number = byte2 & 15
+        index = ((b[1] & 15) << 6) | (b[0] & 63)
+        if index >= len(cls._interned):
+            raise Exception("Invalid cell! number={}".format(b[1] & 15))
+        return cls._interned[index]
 
-        return ImmutableCell(
-            state=state,
-            owner=owner,
-            is_mine=is_mine,
-            number=number
-        )
+    @classmethod
+    def from_packed(cls, byte1, number):
+        '''
+        Trusted fast constructor.
+        byte1 is the first byte of to_bytes() (bits 6,7 clear), number is 0~8.
+        No validation is done - only use this with data that is known to be valid.
+        '''
+        return cls._interned[(number << 6) | byte1]
 
     def modify(self, state=None, owner=None, is_mine=None, number=None):
         if state is None:
@@ -148,6 +173,9 @@ class ImmutableCell():
             pass
 
 
+ImmutableCell._build_intern_table()
+
+
 # Stores user input for "playback"
 # x,y= int (0~)
 # button = int (1~3)
@@ -170,10 +198,8 @@ class MineFieldState:
         result += int(mfs.x).to_bytes(2,"big")
         result += int(mfs.y).to_bytes(2, "big")
 
-        cell_data_bytes=bytearray()
-        for coords in mfs:
-            cell_data_bytes.extend(mfs[coords].to_bytes())
-        result += bytes(cell_data_bytes)
+        cell_data_bytes=b"".join([mfs[coords].to_bytes() for coords in mfs])
+        result += cell_data_bytes
 
         return result
 
@@ -184,11 +210,9 @@ class MineFieldState:
         cell_data=b[4:]
         if len(cell_data) != x*y*2:
             raise Exception("Only {} data in a {}x{} board?".format(len(cell_data),x,y))
-        data=util.multiarray.MultiDimArray(x,y)
-        idx=0
-        for coords in data:
-            data[coords]=ImmutableCell.from_bytes(cell_data[idx:idx+2])
-            idx+=2
+        from_bytes=ImmutableCell.from_bytes
+        cells=[from_bytes(pair) for pair in zip(cell_data[0::2],cell_data[1::2])]
+        data=util.multiarray.MultiDimArray(x,y,data=cells)
 
         return MineFieldState(data)
 
@@ -233,14 +257,23 @@ class MineFieldState:
         Processes user input defined by MineFieldInput mfi
         then returns a new MineFieldState object that results from that input.
         '''
+        return self.process_inputs((mfi,))
+
+    def process_inputs(self,mfis):
+        '''
+        Processes every MineFieldInput in the iterable mfis, in order,
+        then returns the new MineFieldState object that results from all of them.
+        The data is only copied once.
+        '''
         newdata=self._data.shallow_copy()
 
-        if mfi.button==1:
-            self._uncover(newdata,(mfi.x,mfi.y),mfi.player_index)
-        elif mfi.button==2:
-            self._flag(newdata,(mfi.x,mfi.y),mfi.player_index)
-        elif mfi.button==3:
-            self._superclick(newdata,(mfi.x,mfi.y),mfi.player_index)
+        for mfi in mfis:
+            if mfi.button==1:
+                self._uncover(newdata,(mfi.x,mfi.y),mfi.player_index)
+            elif mfi.button==2:
+                self._flag(newdata,(mfi.x,mfi.y),mfi.player_index)
+            elif mfi.button==3:
+                self._superclick(newdata,(mfi.x,mfi.y),mfi.player_index)
 
         return MineFieldState(newdata)
 
@@ -278,23 +311,19 @@ class MineFieldState:
         Superclick (left+right)
         '''
 
-        valid_coords=[]
-        for delta in _neighbor_deltas:
-            coords=Tuples.add(center_coords,delta)
-            if not data.in_bounds(coords):
-                continue
-            valid_coords.append(coords)
+        neighbors=data.neighbor_table()[data.coords_to_index(center_coords)]
 
         minecount = 0
-        for coords in valid_coords:
-            if data[coords].state==CellState.flagged:
+        for index in neighbors:
+            cell=data.get_flat(index)
+            if cell.state==CellState.flagged:
                 minecount+=1
-            elif data[coords].state==CellState.clicked and data[coords].is_mine:
+            elif cell.state==CellState.clicked and cell.is_mine:
                 minecount+=1
 
         if minecount==data[center_coords].number:
-            for coords in valid_coords:
-                cls._uncover(data,coords,player_index)
+            for index in neighbors:
+                cls._uncover(data,data.index_to_coords(index),player_index)
 
     @classmethod
     def _flag(cls,data,coords,player_index):
@@ -313,36 +342,38 @@ class MineFieldState:
         '''
         Uncover a cell, expanding outwards if possible.
         '''
-        uncover_queue=[]
-        uncover_queue.append(initial_coords)
+        neighbor_table=data.neighbor_table()
+        initial_index=data.coords_to_index(initial_coords)
+
+        uncover_queue=collections.deque()
+        uncover_queue.append(initial_index)
+        queued={initial_index} # every cell is queued at most once
 
         while uncover_queue:
-            coords = uncover_queue.pop(0)
-            cell=data[coords]
+            index = uncover_queue.popleft()
+            cell=data.get_flat(index)
             if cell.can_click_by(player_index):
 
-                data[coords]=data[coords].modify(state=CellState.clicked,
-                                                 owner=player_index)
+                data.set_flat(index,cell.modify(state=CellState.clicked,
+                                                owner=player_index))
 
-                if data[coords].is_mine:
+                if cell.is_mine:
                     pass # _could_ do something here
 
                 autoclick= (cell.number==0) and (not cell.is_mine)
 
                 # Modify neighbors
-                for delta in _neighbor_deltas:
-                    newcoords = Tuples.add(coords, delta)
-                    if not data.in_bounds(newcoords):
-                        continue
-
-                    if data[newcoords].state == CellState.locked:
-                        data[newcoords]=data[newcoords].modify(state=CellState.clickable,
-                                                            owner=player_index)
+                for newindex in neighbor_table[index]:
+                    newcell=data.get_flat(newindex)
+                    if newcell.state == CellState.locked:
+                        data.set_flat(newindex,newcell.modify(state=CellState.clickable,
+                                                              owner=player_index))
 
-                    if newcoords in uncover_queue:
+                    if newindex in queued:
                         continue  # no duplicates
                     if autoclick:
-                        uncover_queue.append(newcoords)
+                        uncover_queue.append(newindex)
+                        queued.add(newindex)
 
             else:
                 pass
@@ -361,13 +392,32 @@ class MineFieldEventStack():
     or replace the base state.
     This data structure is a key to maintaing syncronization with the server
     while maintaing responsiveness of the game.
+
+    The intermediate state after each delta is memoized (the "chain"),
+    so adding an input only costs one more step.
+    When deltas are ACKed and the new base state turns out to be equal to
+    the memoized state after those deltas, the rest of the chain is kept as-is.
+    Otherwise all the deltas are replayed on the new base state at once, with process_inputs().
     '''
     def __init__(self,*args,**kwargs):
         super().__init__(*args,**kwargs)
         self._base_state=None
         self._deltas=list()
         self._current_input_index=4000
+
+        # _chain[i] is the state after applying _deltas[:i+1] to _chain_base.
+        # It may be shorter than _deltas; the rest is computed on demand.
+        # Entries skipped over by a batch replay are None.
+        # The chain is only valid while _chain_base is _base_state.
+        self._chain_base=None
+        self._chain=list()
+    @property
+    def base_state(self):
+        return self._base_state
     def set_base_state(self,mfs):
+        if self._chain_base is not None and self._chain_base is not mfs and self._chain_base == mfs:
+            # Same cells as the state the chain was built on - keep the chain
+            self._chain_base=mfs
         self._base_state=mfs
         #self._deltas=list() #<<<WTF????? WHY WAS THIS HERE IN THE FIRST PLACE????
     def add_input(self,mfi):
@@ -376,21 +426,70 @@ class MineFieldEventStack():
         #print("MineFieldEventStack queue size:",len(self._deltas),"just added input #",self._current_input_index)
         return self._current_input_index
     def ack_until(self,input_index):
+        acked=len([i for i in self._deltas if i[0]<=input_index])
         self._deltas=[i for i in self._deltas if i[0]>input_index]
 
+        if acked==0:
+            return
+        if self._chain_base is self._base_state and len(self._chain)>=acked and self._chain[acked-1] is not None:
+            # The chain continues from the state after the ACKed deltas.
+            # It becomes valid again if the next base state equals that state.
+            self._chain_base=self._chain[acked-1]
+            self._chain=self._chain[acked:]
+        else:
+            self._chain_base=None
+            self._chain=list()
+
        # print("input ACK until",input_index,"remaining deltas:",len(self._deltas))
 
     def calaulate_current_state(self):
         if self._base_state is None:
             return None
-        state=self._base_state
-        for delta in self._deltas:
-            mfi=delta[1]
-            state=state.process_input(mfi)
+        if self._chain_base is not self._base_state:
+            # The chain diverged - replay every delta on the new base state in one go
+            self._chain_base=self._base_state
+            if not self._deltas:
+                self._chain=list()
+                return self._base_state
+            state=self._base_state.process_inputs([delta[1] for delta in self._deltas])
+            self._chain=[None]*(len(self._deltas)-1) + [state]
+            return state
+
+        state=self._chain[-1] if self._chain else self._base_state
+        for delta in self._deltas[len(self._chain):]:
+            state=state.process_input(delta[1])
+            self._chain.append(state)
         return state
 
 
 
+def sample_mirror_pairs(num_cells, num_pairs, rng=random):
+    '''
+    Pick num_pairs distinct point-symmetric pairs of cells, uniformly at random,
+    from a field of num_cells cells.
+    In flat index order the mirror of cell i is cell num_cells-1-i,
+    so a pair is identified by its lower index i (0 <= i < num_cells//2).
+    The center cell of an odd-sized field mirrors onto itself and is never picked.
+
+    This is a partial Fisher-Yates shuffle over the pair indices.
+    Only the swapped positions are stored, so it runs in O(num_pairs) time and memory
+    regardless of the field size or density.
+    rng: a random.Random instance, or the random module itself.
+    returns: list of the lower indices of the picked pairs
+    '''
+    available = num_cells // 2
+    if num_pairs > available:
+        num_pairs = available
+
+    swapped = dict()
+    picked = []
+    for k in range(num_pairs):
+        j = rng.randrange(k, available)
+        picked.append(swapped.get(j, j))
+        swapped[j] = swapped.get(k, k)
+    return picked
+
+
 class MineFieldGenerator:
     @classmethod
     def generate_pure_random(cls, x, y, ratio, players):
@@ -433,32 +532,19 @@ class MineFieldGenerator:
         return cls.generate_from_minemap(data,player)
 
     @classmethod
-    def generate_symmetrical_deterministic(cls, x, y, ratio, player):
+    def generate_symmetrical_deterministic(cls, x, y, ratio, player, seed=None):
         '''
-        Same as generate_symmetrical, but deterministic number of mines
+        Same as generate_symmetrical, but deterministic number of mines:
+        exactly 2*round(x*y*ratio/2) mines, or as many as the field can fit. (see sample_mirror_pairs)
+        seed: if given, the same seed always generates the same field.
         '''
 
         data = multiarray.MultiDimArray(x, y, fill=False)
+        num_cells = x*y
 
-        center_coords = ((x - 1) / 2, (y - 1) / 2)
-
-        mines_to_place=round(x*y*ratio/2)
-
-        while mines_to_place>0:
-            coords=(random.randint(0,x-1),random.randint(0,y-1))
-
-            if data[coords]: #Mine is already present
-                continue
-
-            # Some vector math
-            delta = Tuples.sub(coords, center_coords)
-            delta_neg = Tuples.neg(delta)
-            reflected = Tuples.round(Tuples.add(center_coords, delta_neg))
-
-            data[coords] = True
-            data[reflected]=True
-            mines_to_place-=1
-
+        for index in sample_mirror_pairs(num_cells, round(num_cells*ratio/2), random.Random(seed)):
+            data.set_flat(index, True)
+            data.set_flat(num_cells-1-index, True)
 
         return cls.generate_from_minemap(data, player)
 
@@ -477,16 +563,15 @@ class MineFieldGenerator:
         # Before doing anything, calculate the adjacent mine numbers
         numbers = multiarray.MultiDimArray(*minemap.dimensions)
 
-        for coords in minemap:
+        neighbor_table = minemap.neighbor_table()
+        mine_flags = [minemap.get_flat(index) for index in range(len(neighbor_table))]
+        for index, neighbors in enumerate(neighbor_table):
             count = 0
-            for delta in _neighbor_deltas:
-                deltacoords=Tuples.add(coords, delta)
-                if not minemap.in_bounds(deltacoords):
-                    continue
-                if minemap[deltacoords]:
+            for neighbor in neighbors:
+                if mine_flags[neighbor]:
                     count += 1
 
-            numbers[coords] = count
+            numbers.set_flat(index, count)
 
         # the Cells are also stored in a MultiDimArray, with same dimensions as the source data.
         data = multiarray.MultiDimArray(*minemap.dimensions)
@@ -0,0 +1,1224 @@
+'''
+A packed alternative to common.mines.MineFieldState.
+
+PackedMineFieldState stores the whole field as one byte per cell
+instead of one ImmutableCell object per cell.
+The per-cell byte uses the exact same layout as the first byte of ImmutableCell.to_bytes():
+    bits 0,1 : state
+    bits 2,3,4 : owner
+    bit 5 : is_mine
+The adjacent mine numbers never change during a game,
+so they are kept in a separate bytes() object (same layout as the second byte of ImmutableCell.to_bytes())
+that is shared between a state and every state derived from it.
+
+The cell bytes are split into chunks of whole rows (see _CellBuffer).
+A state derived by process_input() shares every chunk the input did not touch with its parent,
+so the cost of an input is proportional to the number of cells it changed, not to the board size.
+
+Alongside the cells, every state keeps BitBoards: arbitrary-precision ints with one bit per cell
+for mines, clicked/flagged/clickable cells and owners, so whole-board questions are popcounts and mask ANDs.
+The masks that change are kept per chunk, and shared between states the same way the chunks are.
+
+The connected regions of zero cells are labelled once per board (see ZeroRegions),
+so clicking a zero cell can reveal its whole region in one bulk write.
+
+Every state also has a version (the number of inputs applied since the board was generated)
+and a Zobrist hash of its cells (see state_hash), which process_input updates from the changed cells only.
+
+PackedMineFieldGenerator creates PackedMineFieldStates directly.
+It uses NumPy when it is installed, and falls back to plain Python when it is not.
+'''
+import array
+import collections
+import functools
+import itertools
+import random
+
+from common import snapshot
+from common.mines import CellState, ImmutableCell, sample_mirror_pairs
+from util import multiarray
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_STATE_MASK = 0b11
+_OWNER_SHIFT = 2
+_OWNER_MASK = 0b111 << _OWNER_SHIFT
+_MINE_BIT = 1 << 5
+_NON_MINE_MASK = _STATE_MASK | _OWNER_MASK
+
+
+# Target number of cells in a chunk. Chunks always hold whole rows, so they may be bigger.
+_CHUNK_TARGET_CELLS = 512
+
+
+def _pack(state, owner, is_mine):
+    return state | (owner << _OWNER_SHIFT) | (_MINE_BIT if is_mine else 0)
+
+
+def _chunk_length(size_y):
+    rows = max(1, _CHUNK_TARGET_CELLS // max(size_y, 1))
+    return rows * max(size_y, 1)
+
+
+def _split_chunks(cells, chunk_len):
+    return tuple(bytes(cells[i:i + chunk_len]) for i in range(0, len(cells), chunk_len))
+
+
+def _cell_score(b, number):
+    '''
+    Same as ImmutableCell.score(), for a packed cell.
+    returns: (player_index, score)
+             or None
+    '''
+    if b & _STATE_MASK != CellState.clicked:
+        return None
+    if b & _MINE_BIT:  # kaboom!
+        return ((b & _OWNER_MASK) >> _OWNER_SHIFT, -200)
+    if number == 0:  # blank
+        return None
+    return ((b & _OWNER_MASK) >> _OWNER_SHIFT, 10)
+
+
+def _is_unopened_safe(b):
+    # A cell that has to be clicked before the game can end
+    return not b & _MINE_BIT and b & _STATE_MASK != CellState.clicked
+
+
+# Debug mode. When enabled, every read of an incrementally maintained value
+# is cross-checked against a full recount of the board.
+# This is slow - only meant for tests and debugging.
+_debug_mode = False
+def set_debug_mode(enabled):
+    global _debug_mode
+    _debug_mode = enabled
+
+
+class IncrementalStateMismatchException(Exception):
+    pass
+
+
+_MASK64 = (1 << 64) - 1
+_ZOBRIST_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def _mix64(z):
+    # splitmix64 finalizer: a cheap, well distributed 64 bit hash
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+
+def _zobrist_key(idx, b):
+    # The random key of packed cell byte b (always < 64) at flat index idx
+    return _mix64((((idx << 6) | b) * _ZOBRIST_MULTIPLIER) & _MASK64)
+
+
+def zobrist_hash(cells, start=0):
+    '''
+    The Zobrist hash of cells, the first one being at flat index start.
+
+    Each cell contributes _zobrist_key(idx, b) ^ _zobrist_key(idx, b & _MINE_BIT):
+    its key, relative to the key of a locked, unowned cell with the same mine bit.
+    Those cells, which are nearly all of a fresh board, contribute nothing,
+    so a tiled board can start from the hash of its edges without generating any tile. (see TileSource.edge_hash)
+    Inputs never change the mine bit, so changing one cell from old to new
+    changes the hash by _zobrist_key(idx, old) ^ _zobrist_key(idx, new).
+    '''
+    if numpy is not None:
+        u64 = numpy.uint64
+        b = numpy.frombuffer(bytes(cells), dtype=numpy.uint8)
+        idx = numpy.flatnonzero(b & _NON_MINE_MASK)
+        if not len(idx):
+            return 0
+        b = b[idx].astype(u64)
+        idx = (idx.astype(u64) + u64(start)) << u64(6)
+        z = numpy.concatenate((idx | b, idx | (b & u64(_MINE_BIT))))
+        z *= u64(_ZOBRIST_MULTIPLIER)
+        z = (z ^ (z >> u64(30))) * u64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> u64(27))) * u64(0x94D049BB133111EB)
+        z ^= z >> u64(31)
+        return int(numpy.bitwise_xor.reduce(z))
+
+    h = 0
+    for idx, b in enumerate(cells, start):
+        if b & _NON_MINE_MASK:
+            h ^= _zobrist_key(idx, b) ^ _zobrist_key(idx, b & _MINE_BIT)
+    return h
+
+
+if hasattr(int, "bit_count"):
+    popcount = int.bit_count
+else:
+    def popcount(mask):
+        return bin(mask).count("1")
+
+
+def _bit_table(predicate):
+    # bytes.translate() table mapping every packed cell byte to b"1" or b"0"
+    return bytes(b"1"[0] if predicate(i) else b"0"[0] for i in range(256))
+
+
+def _to_mask(data, table):
+    '''
+    Bit i of the result is set if table maps data[i] to b"1"
+    '''
+    if not data:
+        return 0
+    return int(data.translate(table)[::-1], 2)
+
+
+class BitBoards:
+    '''
+    One int bit mask per cell property, for a whole PackedMineFieldState.
+    Bit i of a mask is the cell at flat index i.
+
+    mines and nonzero (cells with an adjacent mine number other than 0) never change,
+    and are shared by every BitBoards derived from the same board.
+    The other masks are kept per chunk of cells, like the cells themselves:
+    updated() only rebuilds the masks of the chunks an input touched, and shares the rest.
+    The whole-board masks (clickable, clicked, flagged, owner_planes) are put together when asked for.
+    Owners are stored as 3 bit planes; use owned() to get the mask of a single owner.
+
+    Like the states they belong to, BitBoards are immutable.
+    '''
+    __slots__ = ("size", "full", "mines", "nonzero", "_chunk_len", "_chunk_masks")
+
+    _dynamic = ("clickable", "clicked", "flagged")
+    _tables = {
+        "mines": _bit_table(lambda b: b & _MINE_BIT),
+        "clickable": _bit_table(lambda b: b & _STATE_MASK == CellState.clickable),
+        "clicked": _bit_table(lambda b: b & _STATE_MASK == CellState.clicked),
+        "flagged": _bit_table(lambda b: b & _STATE_MASK == CellState.flagged),
+    }
+    _owner_plane_tables = tuple(_bit_table(lambda b, bit=bit: b & (1 << (_OWNER_SHIFT + bit))) for bit in range(3))
+    _nonzero_table = _bit_table(lambda n: n != 0)
+    # _chunk_masks holds one tuple of per-chunk masks for each of these, in this order
+    _chunked_tables = (_tables["clickable"], _tables["clicked"], _tables["flagged"]) + _owner_plane_tables
+
+    @classmethod
+    def from_chunks(cls, chunks, chunk_len, numbers):
+        '''
+        Build from scratch. chunks are the cell chunks of a state, numbers is bytes with one byte per cell.
+        '''
+        bb = object.__new__(cls)
+        cells = b"".join(chunks)
+        bb.size = len(cells)
+        bb.full = (1 << bb.size) - 1
+        bb.mines = _to_mask(cells, cls._tables["mines"])
+        bb.nonzero = _to_mask(numbers, cls._nonzero_table)
+        bb._chunk_len = chunk_len
+        bb._chunk_masks = tuple(tuple(_to_mask(chunk, table) for chunk in chunks) for table in cls._chunked_tables)
+        return bb
+
+    def updated(self, new_chunks, touched):
+        '''
+        The BitBoards for new_chunks, given that only the chunks with their index in touched
+        differ from the chunks these are for.
+        '''
+        bb = object.__new__(BitBoards)
+        bb.size = self.size
+        bb.full = self.full
+        bb.mines = self.mines
+        bb.nonzero = self.nonzero
+        bb._chunk_len = self._chunk_len
+
+        chunk_masks = []
+        for masks, table in zip(self._chunk_masks, self._chunked_tables):
+            masks = list(masks)
+            for c in touched:
+                masks[c] = _to_mask(new_chunks[c], table)
+            chunk_masks.append(tuple(masks))
+        bb._chunk_masks = tuple(chunk_masks)
+        return bb
+
+    def _joined(self, masks):
+        # Whole-board mask from per-chunk masks. Every chunk but the last one is exactly _chunk_len cells
+        width = "0{}b".format(self._chunk_len)
+        return int("".join([format(masks[-1], "b")] + [format(mask, width) for mask in reversed(masks[:-1])]), 2)
+
+    @property
+    def clickable(self):
+        return self._joined(self._chunk_masks[0])
+
+    @property
+    def clicked(self):
+        return self._joined(self._chunk_masks[1])
+
+    @property
+    def flagged(self):
+        return self._joined(self._chunk_masks[2])
+
+    @property
+    def owner_planes(self):
+        return tuple(self._joined(masks) for masks in self._chunk_masks[3:])
+
+    def __eq__(self, other):
+        if not isinstance(other, BitBoards):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    __hash__ = None
+
+    @property
+    def locked(self):
+        return self.full & ~(self.clickable | self.clicked | self.flagged)
+
+    def state(self, state):
+        return (self.locked, self.clickable, self.clicked, self.flagged)[state]
+
+    def owned(self, owner):
+        return self._owned(owner, self.owner_planes)
+
+    def owners(self):
+        '''
+        owned() of every owner, 0 to 7. Cheaper than calling owned() 8 times.
+        '''
+        planes = self.owner_planes
+        return [self._owned(owner, planes) for owner in range(8)]
+
+    def _owned(self, owner, planes):
+        mask = self.full
+        for bit, plane in enumerate(planes):
+            if owner & (1 << bit):
+                mask &= plane
+            else:
+                mask &= ~plane
+        return mask
+
+
+class ZeroRegions:
+    '''
+    The connected regions of zero cells (non-mine cells without adjacent mines) of a board,
+    together with their border (the numbered cells around them).
+    This only depends on the mines, so it is computed once per board and shared by all of its states.
+
+    Stored compactly, as flat int arrays:
+      labels[i]:  region of the cell at flat index i, or -1 if it is not a zero cell
+      members[starts[r]:border_starts[r]]:  the zero cells of region r
+      members[border_starts[r]:starts[r+1]]:  the border cells of region r.
+                                              A border cell can belong to several regions.
+    '''
+    __slots__ = ("labels", "starts", "border_starts", "members")
+
+    def __init__(self, x, y, numbers, mines):
+        '''
+        numbers: bytes, the adjacent mine numbers
+        mines:   bytes, nonzero for mines
+        '''
+        # Regions are numbered in the order of their lowest flat index. Cells within a region are in no particular order.
+        if numpy is not None:
+            self.labels, self.starts, self.border_starts, self.members = self._label_numpy(x, y, numbers, mines)
+        else:
+            self.labels, self.starts, self.border_starts, self.members = self._label_runs(x, y, numbers, mines)
+
+    @staticmethod
+    def _label_runs(x, y, numbers, mines):
+        # Union-find over the runs of zero cells in each row. Two runs in neighboring rows
+        # are connected if they overlap, diagonals included.
+        n = x * y
+        # OR the two byte strings together as big ints (bytewise OR never carries), then map 0 to 1 and the rest to 0
+        either = (int.from_bytes(numbers, "big") | int.from_bytes(mines, "big")).to_bytes(n, "big")
+        is_zero = either.translate(_ZERO_TABLE)
+
+        runs = []        # (start, end) flat indices, end exclusive
+        row_runs = []    # (first, last+1) indices into runs, per row
+        parent = []
+
+        def find(r):
+            while parent[r] != r:
+                parent[r] = parent[parent[r]]
+                r = parent[r]
+            return r
+
+        for row in range(x):
+            base = row * y
+            first = len(runs)
+            col = is_zero.find(1, base, base + y)
+            while col != -1:
+                end = is_zero.find(0, col, base + y)
+                if end == -1:
+                    end = base + y
+                runs.append((col, end))
+                parent.append(len(parent))
+                col = is_zero.find(1, end, base + y)
+            row_runs.append((first, len(runs)))
+
+            if row > 0:
+                i, i_end = row_runs[row - 1]
+                j, j_end = first, len(runs)
+                while i < i_end and j < j_end:
+                    (a, b), (c, d) = runs[i], runs[j]
+                    # Columns [a-y, b-y) and [c-base, d-base) touch if they overlap or are diagonal neighbors
+                    if a + y <= d and c <= b + y:
+                        ri, rj = find(i), find(j)
+                        if ri != rj:
+                            parent[max(ri, rj)] = min(ri, rj)
+                    if b + y < d:
+                        i += 1
+                    else:
+                        j += 1
+
+        labels = array.array("i", [-1]) * n
+        region_runs = collections.defaultdict(list)
+        for r, (start, end) in enumerate(runs):
+            region_runs[find(r)].append((start, end))
+
+        starts = array.array("i")
+        border_starts = array.array("i")
+        members = array.array("i")
+        # The roots are the lowest run of each region, so sorting them numbers regions by their lowest cell
+        for label, root in enumerate(sorted(region_runs)):
+            starts.append(len(members))
+            border = dict()
+            for start, end in region_runs[root]:
+                labels[start:end] = array.array("i", [label]) * (end - start)
+                members.extend(range(start, end))
+
+                row, col = divmod(start, y)
+                lo = col - 1 if col > 0 else col
+                hi = end - row * y + 1 if end - row * y < y else end - row * y
+                for r in (row - 1, row, row + 1):
+                    if 0 <= r < x:
+                        first = r * y + lo
+                        for i, zero in enumerate(is_zero[first:r * y + hi], first):
+                            if not zero:
+                                border[i] = None
+            border_starts.append(len(members))
+            members.extend(border)
+        starts.append(len(members))
+        return labels, starts, border_starts, members
+
+    @staticmethod
+    def _label_numpy(x, y, numbers, mines):
+        # Union-find over all cells at once. Cells of a run of zeros within a row start out pointing at the start of their run,
+        # so only the edges between rows are left: hook each of those onto the lower root,
+        # then shortcut the parent pointers, until no edge connects two different roots.
+        # The root of a region ends up being its lowest flat index.
+        n = x * y
+        zero = ((numpy.frombuffer(bytes(numbers), dtype=numpy.uint8) == 0) &
+                (numpy.frombuffer(bytes(mines), dtype=numpy.uint8) == 0)).reshape((x, y))
+        index = numpy.arange(n, dtype=numpy.int64).reshape((x, y))
+
+        run_start = numpy.where(zero, index, 0)
+        run_start[:, 1:][zero[:, 1:] & zero[:, :-1]] = 0
+        numpy.maximum.accumulate(run_start, axis=1, out=run_start)
+
+        heads, tails = [], []
+        for dy in (-1, 0, 1):
+            src = (slice(0, x - 1), slice(max(0, -dy), y - max(0, dy)))
+            dst = (slice(1, x), slice(max(0, dy), y - max(0, -dy)))
+            both = zero[src] & zero[dst]
+            # Two runs touch along a stretch of columns: one edge per stretch is enough
+            both[:, 1:] &= ~both[:, :-1]
+            heads.append(run_start[src][both])
+            tails.append(run_start[dst][both])
+        heads = numpy.concatenate(heads)
+        tails = numpy.concatenate(tails)
+
+        parent = numpy.where(zero, run_start, index).ravel()
+        while True:
+            ph, pt = parent[heads], parent[tails]
+            differ = ph != pt
+            if not differ.any():
+                break
+            numpy.minimum.at(parent, numpy.maximum(ph, pt)[differ], numpy.minimum(ph, pt)[differ])
+            while True:
+                grandparent = parent[parent]
+                if (grandparent == parent).all():
+                    break
+                parent = grandparent
+
+        flat_zero = zero.ravel()
+        zero_cells = numpy.flatnonzero(flat_zero)
+        roots = zero_cells[parent[zero_cells] == zero_cells]
+        labels = numpy.full(n, -1, dtype=numpy.int64)
+        labels[roots] = numpy.arange(len(roots))
+        zero_labels = labels[parent[zero_cells]]
+        labels[zero_cells] = zero_labels
+        label_grid = labels.reshape((x, y))
+
+        # Border: every (label, non-zero cell) pair of neighbors, in both directions of each edge
+        border_labels, border_cells = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if dx == 0 and dy == 0:
+                    continue
+                src = (slice(max(0, -dx), x - max(0, dx)), slice(max(0, -dy), y - max(0, dy)))
+                dst = (slice(max(0, dx), x - max(0, -dx)), slice(max(0, dy), y - max(0, -dy)))
+                pair = zero[src] & ~zero[dst]
+                border_labels.append(label_grid[src][pair].astype(numpy.int64))
+                border_cells.append(index[dst][pair])
+        border = numpy.sort(numpy.concatenate(border_labels) * n + numpy.concatenate(border_cells))
+        if len(border):
+            border = border[numpy.concatenate(([True], border[1:] != border[:-1]))]
+        border_labels, border_cells = numpy.divmod(border, n)
+
+        count = len(roots)
+        zero_counts = numpy.bincount(zero_labels, minlength=count)
+        border_counts = numpy.bincount(border_labels, minlength=count)
+        starts = numpy.zeros(count + 1, dtype=numpy.int64)
+        numpy.cumsum(zero_counts + border_counts, out=starts[1:])
+        border_starts = starts[:-1] + zero_counts
+
+        members = numpy.empty(starts[-1], dtype=numpy.int32)
+        order = numpy.argsort(zero_labels, kind="stable")
+        sorted_labels = zero_labels[order]
+        members[starts[sorted_labels] + (numpy.arange(len(order)) - numpy.searchsorted(sorted_labels, sorted_labels))] \
+            = zero_cells[order]
+        # border is sorted by label already
+        members[border_starts[border_labels] +
+                (numpy.arange(len(border_labels)) - numpy.searchsorted(border_labels, border_labels))] = border_cells
+
+        def to_array(a):
+            return array.array("i", a.astype(numpy.int32).tobytes())
+        return to_array(labels), to_array(starts), to_array(border_starts), to_array(members)
+
+    def region(self, label):
+        '''
+        returns: (zero cells, border cells) of a region, as memoryviews of flat indices
+        '''
+        members = memoryview(self.members)
+        return (members[self.starts[label]:self.border_starts[label]],
+                members[self.border_starts[label]:self.starts[label + 1]])
+
+
+_ZERO_TABLE = bytes([1]) + bytes(255)
+_MINE_TABLE = bytes(_MINE_BIT if i & _MINE_BIT else 0 for i in range(256))
+
+
+@functools.lru_cache(maxsize=16)
+def zero_regions(x, y, numbers, mines):
+    '''
+    Cached ZeroRegions, so every state (and every room) with the same board shares one.
+    '''
+    return ZeroRegions(x, y, numbers, mines)
+
+
+@functools.lru_cache(maxsize=16)
+def numbers_from_mines(x, y, mines):
+    '''
+    The adjacent mine numbers of a board, as bytes.
+    mines: bytes, nonzero for mines
+    Cached, since every snapshot of a game has the same mines.
+    '''
+    if numpy is not None:
+        return bytes(PackedMineFieldGenerator._cells_and_numbers_numpy(mines, x, y)[1])
+    return bytes(PackedMineFieldGenerator._cells_and_numbers_python(mines, x, y)[1])
+
+
+class _CellBuffer:
+    '''
+    Copy-on-write working buffer over the cell chunks of a PackedMineFieldState.
+    Reading and writing is done with flat indices, like a bytearray.
+    The first write to a chunk copies that chunk; all other chunks stay shared with the source state.
+    freeze() returns the resulting chunks, ready to be handed to a new PackedMineFieldState.
+    '''
+    __slots__ = ("_chunks", "_chunk_len", "_copied", "_original")
+
+    def __init__(self, chunks, chunk_len):
+        self._chunks = list(chunks)
+        self._chunk_len = chunk_len
+        self._copied = set()
+        self._original = dict()  # flat index -> value before the first write
+
+    def __getitem__(self, idx):
+        c, offset = divmod(idx, self._chunk_len)
+        return self._chunks[c][offset]
+
+    def __setitem__(self, idx, value):
+        c, offset = divmod(idx, self._chunk_len)
+        if c not in self._copied:
+            self._chunks[c] = bytearray(self._chunks[c])
+            self._copied.add(c)
+        chunk = self._chunks[c]
+        if idx not in self._original:
+            self._original[idx] = chunk[offset]
+        chunk[offset] = value
+
+    def changes(self):
+        '''
+        Every cell that differs from the source state.
+        returns: a list of (flat index, old value, new value)
+        '''
+        result = []
+        for idx, old in self._original.items():
+            new = self[idx]
+            if new != old:
+                result.append((idx, old, new))
+        return result
+
+    def freeze(self):
+        chunks = self._chunks
+        for c in self._copied:
+            chunks[c] = bytes(chunks[c])
+        self._copied = set()
+        self._original = dict()
+        return tuple(chunks)
+
+
+class PackedMineFieldState:
+    '''
+    An IMMUTABLE minefield, stored as packed bytes.
+    Exposes the same interface as common.mines.MineFieldState;
+    indexing a PackedMineFieldState returns an ImmutableCell.
+
+    Cells are stored in the same order MultiDimArray uses:
+    the flat index of (x,y) is x*size_y+y.
+    '''
+
+    @classmethod
+    def to_bytes(cls, mfs):
+        result = bytearray()
+        result += int(mfs.x).to_bytes(2, "big")
+        result += int(mfs.y).to_bytes(2, "big")
+
+        cell_data_bytes = bytearray(len(mfs._numbers) * 2)
+        cell_data_bytes[0::2] = b"".join(mfs._chunks)
+        cell_data_bytes[1::2] = mfs._numbers
+        result += cell_data_bytes
+
+        return bytes(result)
+
+    @classmethod
+    def from_bytes(cls, b):
+        x = int.from_bytes(b[0:2], "big")
+        y = int.from_bytes(b[2:4], "big")
+        cell_data = b[4:]
+        if len(cell_data) != x * y * 2:
+            raise Exception("Only {} data in a {}x{} board?".format(len(cell_data), x, y))
+
+        cells = cell_data[0::2]
+        numbers = bytes(cell_data[1::2])
+        return PackedMineFieldState(x, y, _split_chunks(cells, _chunk_length(y)), numbers)
+
+    @classmethod
+    def to_compact_bytes(cls, mfs, compression=snapshot.COMPRESSION_NONE):
+        '''
+        Encode as a compact snapshot (see common.snapshot): one byte per cell, optionally compressed.
+        '''
+        return snapshot.encode(mfs.x, mfs.y, b"".join(mfs._chunks), compression)
+
+    @classmethod
+    def from_compact_bytes(cls, b, version=0):
+        '''
+        version: the version of the encoded state. (it is not part of the snapshot)
+        '''
+        x, y, cells = snapshot.decode(b)
+        numbers = numbers_from_mines(x, y, cells.translate(_MINE_TABLE))
+        return PackedMineFieldState(x, y, _split_chunks(cells, _chunk_length(y)), numbers, version=version)
+
+    @classmethod
+    def from_minefield(cls, mf):
+        '''
+        Convert any minefield (a MineFieldState, for example) into a PackedMineFieldState
+        '''
+        cells = bytearray(mf.x * mf.y)
+        numbers = bytearray(mf.x * mf.y)
+
+        idx = 0
+        for coords in mf:
+            cell = mf[coords]
+            cells[idx] = _pack(cell.state, cell.owner, cell.is_mine)
+            numbers[idx] = cell.number
+            idx += 1
+
+        return PackedMineFieldState(mf.x, mf.y, _split_chunks(cells, _chunk_length(mf.y)), bytes(numbers))
+
+    def __init__(self, x, y, chunks, numbers, scores=None, unopened=None, bitboards=None, regions=None,
+                 version=0, zobrist=None):
+        '''
+        Initialize a minefield from packed data.
+        x,y:     dimensions
+        chunks:  tuple of bytes, the packed cells split into chunks of _chunk_length(y) cells.
+                 The chunks may be shared with other states, so they must never be modified.
+        numbers: bytes, the adjacent mine number of each cell.
+        scores:  the score ledger (see calculate_scores) for this data, if already known.
+                 Counted from the cells if None.
+        unopened: the number of unopened non-mine cells for each owner (a list of 8 ints), if already known.
+                 Counted from the cells if None.
+        bitboards: the BitBoards for this data, if already known. Built from the cells if None.
+        regions: the ZeroRegions of this board, if already known. Looked up on first use if None.
+        version: the number of inputs applied since the board was generated.
+        zobrist: the state_hash() of this data, if already known. Computed on first use if None.
+        '''
+        if sum(len(c) for c in chunks) != x * y or len(numbers) != x * y:
+            raise ValueError("Number of data does not match the dimensions!")
+        self._x = x
+        self._y = y
+        self._chunk_len = _chunk_length(y)
+        self._chunks = chunks
+        self._numbers = numbers
+
+        self._regions = regions
+        self._version = version
+        self._zobrist = zobrist
+
+        if bitboards is None:
+            bitboards = BitBoards.from_chunks(chunks, self._chunk_len, numbers)
+        self._bitboards = bitboards
+
+        if scores is None:
+            scores = self._scores_from_bitboards()
+        self._scores = scores
+
+        if unopened is None:
+            unopened = self._unopened_from_bitboards()
+        self._unopened = unopened
+
+    @property
+    def _zero_regions(self):
+        if self._regions is None:
+            mines = b"".join(self._chunks).translate(_MINE_TABLE)
+            self._regions = zero_regions(self._x, self._y, self._numbers, mines)
+        return self._regions
+
+    @property
+    def _neighbor_table(self):
+        # Looked up on first use, so creating a state never has to build the table
+        return multiarray.neighbor_table((self._x, self._y))
+
+    @property
+    def dimensions(self):
+        return (self._x, self._y)
+    @property
+    def x(self):
+        return self._x
+    @property
+    def y(self):
+        return self._y
+
+    def __iter__(self):
+        return self.indices()
+    def indices(self):
+        return itertools.product(range(self._x), range(self._y))
+
+    def _coord_to_index(self, coords):
+        cx, cy = coords
+        if cx < 0 or cx >= self._x or cy < 0 or cy >= self._y:
+            raise multiarray.InvalidCoordinatesException(
+                "Received {} in a {}x{} field!".format(coords, self._x, self._y))
+        return cx * self._y + cy
+
+    def __getitem__(self, key):
+        idx = self._coord_to_index(key)
+        c, offset = divmod(idx, self._chunk_len)
+        return ImmutableCell.from_packed(self._chunks[c][offset], self._numbers[idx])
+
+    def process_input(self, mfi, return_changes=False):
+        '''
+        Processes user input defined by MineFieldInput mfi
+        then returns a new PackedMineFieldState object that results from that input.
+        If return_changes is True, returns (new state, changes) instead,
+        where changes is a sorted list of the flat indices of every cell the input changed.
+        '''
+        return self.process_inputs((mfi,), return_changes)
+
+    def process_inputs(self, mfis, return_changes=False):
+        '''
+        Processes every MineFieldInput in the iterable mfis, in order,
+        then returns the new PackedMineFieldState object that results from all of them.
+        All inputs are applied to a single working buffer,
+        so this is much cheaper than calling process_input for each input.
+        return_changes works like in process_input; the changes are relative to this state.
+        '''
+        newcells = _CellBuffer(self._chunks, self._chunk_len)
+        inputs = 0
+        for mfi in mfis:
+            self._apply(newcells, mfi)
+            inputs += 1
+
+        changes = newcells.changes()
+        newstate = self._derive(newcells, changes, self._version + inputs)
+        if return_changes:
+            return newstate, sorted([change[0] for change in changes])
+        return newstate
+
+    def _apply(self, newcells, mfi):
+        idx = self._coord_to_index((mfi.x, mfi.y))
+
+        if mfi.button == 1:
+            self._uncover(newcells, idx, mfi.player_index)
+        elif mfi.button == 2:
+            self._flag(newcells, idx, mfi.player_index)
+        elif mfi.button == 3:
+            self._superclick(newcells, idx, mfi.player_index)
+
+    def _derive(self, newcells, changes, version):
+        '''
+        Create the state that results from the modifications in the _CellBuffer newcells.
+        changes is newcells.changes(), version the version of the new state.
+        Everything that is maintained incrementally is updated from the changed cells only.
+        '''
+        numbers = self._numbers
+        scores = dict(self._scores)
+        unopened = list(self._unopened)
+        zobrist = self._zobrist
+        touched = set()
+        for idx, old, new in changes:
+            touched.add(idx // self._chunk_len)
+
+            if zobrist is not None:
+                zobrist ^= _zobrist_key(idx, old) ^ _zobrist_key(idx, new)
+
+            if _is_unopened_safe(old):
+                unopened[(old & _OWNER_MASK) >> _OWNER_SHIFT] -= 1
+            if _is_unopened_safe(new):
+                unopened[(new & _OWNER_MASK) >> _OWNER_SHIFT] += 1
+
+            old_score = _cell_score(old, numbers[idx])
+            if old_score is not None:
+                scores[old_score[0]] -= old_score[1]
+            new_score = _cell_score(new, numbers[idx])
+            if new_score is not None:
+                scores[new_score[0]] = scores.get(new_score[0], 0) + new_score[1]
+
+        newchunks = newcells.freeze()
+        bitboards = self._bitboards.updated(newchunks, touched)
+        return PackedMineFieldState(self._x, self._y, newchunks, numbers,
+                                    scores=scores, unopened=unopened, bitboards=bitboards, regions=self._regions,
+                                    version=version, zobrist=zobrist)
+
+    def __eq__(self, other):
+        '''
+        Two states are equal if all of their cells are equal.
+        Shared chunks are not compared byte by byte.
+        '''
+        if not isinstance(other, PackedMineFieldState):
+            return NotImplemented
+        if self.dimensions != other.dimensions or self._numbers != other._numbers:
+            return False
+        for mine, theirs in zip(self._chunks, other._chunks):
+            if mine is not theirs and mine != theirs:
+                return False
+        return True
+
+    __hash__ = None
+
+    def changed_indices(self, other):
+        '''
+        Sorted flat indices of every cell that differs between this state and other. (same dimensions)
+        Chunks shared between the two states are skipped without looking at them,
+        and the remaining chunks are compared as a whole before looking at single cells.
+        '''
+        if self.dimensions != other.dimensions:
+            raise ValueError("Cannot compare fields of different dimensions!")
+        result = []
+        for c, (mine, theirs) in enumerate(zip(self._chunks, other._chunks)):
+            if mine is theirs or mine == theirs:
+                continue
+            base = c * self._chunk_len
+            result.extend(base + offset for offset in range(len(mine)) if mine[offset] != theirs[offset])
+        return result
+
+    def index_to_coords(self, idx):
+        return divmod(idx, self._y)
+
+    @property
+    def version(self):
+        return self._version
+
+    def state_hash(self):
+        '''
+        A 64 bit Zobrist hash of every cell. Equal states have equal hashes,
+        whichever engine (packed or tiled) they come from.
+        Computed once per board, then updated incrementally from the changed cells of every input.
+        '''
+        if self._zobrist is None:
+            self._zobrist = zobrist_hash(b"".join(self._chunks))
+        elif _debug_mode:
+            recounted = zobrist_hash(b"".join(self._chunks))
+            if recounted != self._zobrist:
+                raise IncrementalStateMismatchException(
+                    "Hash {} does not match the board {}".format(self._zobrist, recounted))
+        return self._zobrist
+
+    def cell_bytes(self, indices):
+        '''
+        returns: bytes, the packed cell byte of each flat index in indices
+        '''
+        chunks = self._chunks
+        chunk_len = self._chunk_len
+        return bytes(chunks[idx // chunk_len][idx % chunk_len] for idx in indices)
+
+    def apply_patch(self, indices, cells, version=None):
+        '''
+        Returns the state that results from overwriting the cell at each flat index in indices
+        with the packed cell byte at the same position in cells. (see cell_bytes)
+        Like process_input, only the changed cells are looked at.
+        version: the version of the resulting state. Same as this state's if None.
+        '''
+        newcells = _CellBuffer(self._chunks, self._chunk_len)
+        size = self._x * self._y
+        for idx, b in zip(indices, cells):
+            if not 0 <= idx < size:
+                raise multiarray.InvalidCoordinatesException(
+                    "Received index {} in a {}x{} field!".format(idx, self._x, self._y))
+            newcells[idx] = b
+        return self._derive(newcells, newcells.changes(), self._version if version is None else version)
+
+    @property
+    def bitboards(self):
+        if _debug_mode:
+            rebuilt = BitBoards.from_chunks(self._chunks, self._chunk_len, self._numbers)
+            if rebuilt != self._bitboards:
+                raise IncrementalStateMismatchException("BitBoards do not match the board")
+        return self._bitboards
+
+    def count_cells(self, state=None, owner=None, is_mine=None):
+        '''
+        Number of cells matching all of the given properties. (None matches everything)
+        '''
+        bb = self.bitboards
+        mask = bb.full
+        if state is not None:
+            mask &= bb.state(state)
+        if owner is not None:
+            mask &= bb.owned(owner)
+        if is_mine is not None:
+            mask &= bb.mines if is_mine else ~bb.mines
+        return popcount(mask)
+
+    def calculate_scores(self):
+        '''
+        returns: dict of player_index -> score
+        The scores are kept up to date by process_input, so this is O(players).
+        '''
+        if _debug_mode:
+            recounted = self._recount_scores()
+            if recounted != self._scores or self._scores_from_bitboards() != self._scores:
+                raise IncrementalStateMismatchException(
+                    "Score ledger {} does not match the board {}".format(self._scores, recounted))
+        return dict(self._scores)
+
+    def _scores_from_bitboards(self):
+        bb = self._bitboards
+        scores = {}
+        all_clicked = bb.clicked
+        for owner, owned in enumerate(bb.owners()):
+            clicked = all_clicked & owned
+            if not clicked:
+                continue
+            exploded = popcount(clicked & bb.mines)
+            numbered = popcount(clicked & ~bb.mines & bb.nonzero)
+            if exploded or numbered:
+                scores[owner] = exploded * -200 + numbered * 10
+        return scores
+
+    def _recount_scores(self):
+        scores = {}
+        numbers = self._numbers
+        for idx, b in enumerate(itertools.chain.from_iterable(self._chunks)):
+            score = _cell_score(b, numbers[idx])
+            if score is not None:
+                scores[score[0]] = scores.get(score[0], 0) + score[1]
+        return scores
+
+    def check_all_opened(self, player_filter=(1, 2, 3, 4)):
+        '''
+        Are all non-mine cells that are unowned or owned by a player in player_filter clicked?
+        The unopened cell counters are kept up to date by process_input, so this is O(players).
+        '''
+        owners = set(player_filter)
+        owners.add(0)
+        remaining = sum(self._unopened[owner] for owner in owners if 0 <= owner < len(self._unopened))
+        if _debug_mode:
+            recounted = self._recount_unopened()
+            if recounted != self._unopened or self._unopened_from_bitboards() != self._unopened:
+                raise IncrementalStateMismatchException(
+                    "Unopened cell counters {} do not match the board {}".format(self._unopened, recounted))
+        return remaining == 0
+
+    def _unopened_from_bitboards(self):
+        bb = self._bitboards
+        unopened_safe = bb.full & ~bb.mines & ~bb.clicked
+        return [popcount(unopened_safe & owned) for owned in bb.owners()]
+
+    def _recount_unopened(self):
+        unopened = [0] * 8
+        for b, count in collections.Counter(b"".join(self._chunks)).items():
+            if _is_unopened_safe(b):
+                unopened[(b & _OWNER_MASK) >> _OWNER_SHIFT] += count
+        return unopened
+
+    def _superclick(self, cells, center_idx, player_index):
+        '''
+        Superclick (left+right)
+        '''
+        neighbors = self._neighbor_table[center_idx]
+
+        minecount = 0
+        for idx in neighbors:
+            b = cells[idx]
+            if b & _STATE_MASK == CellState.flagged:
+                minecount += 1
+            elif b & _STATE_MASK == CellState.clicked and b & _MINE_BIT:
+                minecount += 1
+
+        if minecount == self._numbers[center_idx]:
+            for idx in neighbors:
+                self._uncover(cells, idx, player_index)
+
+    def _flag(self, cells, idx, player_index):
+        '''
+        Place a flag
+        '''
+        b = cells[idx]
+        if b & _STATE_MASK == CellState.flagged:
+            if (b & _OWNER_MASK) >> _OWNER_SHIFT == player_index:
+                cells[idx] = (b & ~_STATE_MASK) | CellState.clickable
+
+        elif b & _NON_MINE_MASK == _pack(CellState.clickable, player_index, False):
+            cells[idx] = (b & ~_STATE_MASK) | CellState.flagged
+
+    def _reveal_region(self, cells, idx, player_index):
+        '''
+        Reveal the whole zero region of the cell at idx at once, if every cell of it and its border
+        is either locked or clickable by player_index.
+        In that case a flood fill would click exactly those cells, then unlock the locked cells around the border.
+        returns: False if the region does not qualify; nothing is changed then.
+        '''
+        regions = self._zero_regions
+        zeros, border = regions.region(regions.labels[idx])
+        clickable = _pack(CellState.clickable, player_index, False)
+        clicked = _pack(CellState.clicked, player_index, False)
+
+        for i in itertools.chain(zeros, border):
+            b = cells[i]
+            if b != clickable and b & _STATE_MASK != CellState.locked:
+                return False
+
+        for i in itertools.chain(zeros, border):
+            cells[i] = clicked
+        neighbor_table = self._neighbor_table
+        for i in border:
+            for neighbor in neighbor_table[i]:
+                b = cells[neighbor]
+                if b & _STATE_MASK == CellState.locked:
+                    cells[neighbor] = clickable | (b & _MINE_BIT)
+        return True
+
+    def _uncover(self, cells, initial_idx, player_index):
+        '''
+        Uncover a cell, expanding outwards if possible.
+
+        Zero regions are filled one horizontal span at a time:
+        a run of zero cells in a row is clicked at once,
+        and only the cells in the rows directly above and below the run are queued.
+        Every cell is queued at most once, so the whole fill is linear in the number of cells it touches.
+        The result is identical to a plain breadth-first fill.
+
+        If the first cell is a zero cell whose whole region is still untouched (or only opened to this player),
+        the precomputed region is revealed in bulk instead. (see _reveal_region)
+        '''
+        clickable = _pack(CellState.clickable, player_index, False)
+        clicked = _pack(CellState.clicked, player_index, False)
+        numbers = self._numbers
+        neighbor_table = self._neighbor_table
+        size_x = self._x
+        size_y = self._y
+
+        if numbers[initial_idx] == 0 and cells[initial_idx] == clickable:
+            if self._reveal_region(cells, initial_idx, player_index):
+                return
+
+        def can_expand(i):
+            # Would this cell be clicked, and keep the fill going, if a zero cell next to it was clicked?
+            b = cells[i]
+            return (numbers[i] == 0 and not b & _MINE_BIT
+                    and (b & _STATE_MASK == CellState.locked or b == clickable))
+
+        def unlock_and_queue(i):
+            b = cells[i]
+            if b & _STATE_MASK == CellState.locked:
+                b = clickable | (b & _MINE_BIT)
+                cells[i] = b
+            if b & _NON_MINE_MASK == clickable and i not in queued:
+                uncover_queue.append(i)
+                queued.add(i)
+
+        uncover_queue = collections.deque((initial_idx,))
+        queued = {initial_idx}
+
+        while uncover_queue:
+            idx = uncover_queue.popleft()
+            b = cells[idx]
+            if b & _NON_MINE_MASK != clickable:
+                continue
+
+            if numbers[idx] != 0 or b & _MINE_BIT:
+                # A single cell - click it and unlock its neighbors
+                cells[idx] = clicked | (b & _MINE_BIT)
+                for nidx in neighbor_table[idx]:
+                    nb = cells[nidx]
+                    if nb & _STATE_MASK == CellState.locked:
+                        cells[nidx] = clickable | (nb & _MINE_BIT)
+                continue
+
+            # A zero cell - find the whole span of zero cells in this row
+            row_start = idx - idx % size_y
+            row_end = row_start + size_y
+            lo = idx
+            while lo > row_start and can_expand(lo - 1):
+                lo -= 1
+            hi = idx + 1
+            while hi < row_end and can_expand(hi):
+                hi += 1
+
+            for i in range(lo, hi):
+                cells[i] = clicked
+                queued.add(i)
+
+            # The span's neighbors: both ends in this row, and the rows above and below
+            if lo > row_start:
+                unlock_and_queue(lo - 1)
+            if hi < row_end:
+                unlock_and_queue(hi)
+            n_lo = lo - 1 if lo > row_start else lo
+            n_hi = hi + 1 if hi < row_end else hi
+            if row_start > 0:
+                for i in range(n_lo - size_y, n_hi - size_y):
+                    unlock_and_queue(i)
+            if row_end < size_x * size_y:
+                for i in range(n_lo + size_y, n_hi + size_y):
+                    unlock_and_queue(i)
+
+
+class PackedMineFieldGenerator:
+    '''
+    Same as common.mines.MineFieldGenerator, but creates PackedMineFieldStates directly.
+
+    Mine maps are flat sequences of 0/1 values, in the same order as the cells of a PackedMineFieldState.
+    In that order the point-symmetric mirror of flat index i is always n-1-i,
+    so mirroring a mine map is just reversing it.
+
+    When NumPy is available the mine map, the mirroring and the adjacent mine numbers are computed as array operations.
+    '''
+
+    @classmethod
+    def generate_symmetrical(cls, x, y, ratio, players, seed=None):
+        '''
+        Generate a symmetrical minefield.
+        All the mines will be point-symmetrical, the center point being the center of the field.
+        Every mirrored pair of cells (and the center cell, if there is one) is rolled independently.
+        seed: if given, the same seed always generates the same field.
+        '''
+        n = x * y
+        half = (n + 1) // 2  # the first half, center included
+        rng = random.Random(seed)
+
+        # One 32 bit roll per cell, drawn from rng the same way whether numpy is there or not,
+        # so a seed generates the same field on both code paths
+        rolls = rng.randbytes(4 * half)
+        threshold = int(ratio * (1 << 32))
+
+        if numpy is not None:
+            first = numpy.frombuffer(rolls, dtype=numpy.uint32) < threshold
+            minemap = numpy.concatenate((first, first[:n - half][::-1]))
+        else:
+            first = bytes([roll < threshold for roll in memoryview(rolls).cast("I")])
+            minemap = first + first[:n - half][::-1]
+
+        return cls.generate_from_minemap(minemap, x, y, players)
+
+    @classmethod
+    def generate_symmetrical_deterministic(cls, x, y, ratio, players, seed=None):
+        '''
+        Same as generate_symmetrical, but deterministic number of mines
+        (see MineFieldGenerator.generate_symmetrical_deterministic)
+        '''
+        n = x * y
+        minemap = bytearray(n)
+
+        for idx in sample_mirror_pairs(n, round(n * ratio / 2), random.Random(seed)):
+            minemap[idx] = 1
+            minemap[n - 1 - idx] = 1
+
+        return cls.generate_from_minemap(minemap, x, y, players)
+
+    @classmethod
+    def generate_from_minemap(cls, minemap, x, y, players=2):
+        '''
+        Initialize a minefield.
+        minemap is a flat sequence of x*y values (bytes, a list, a NumPy array...)
+        A true value means a mine is present at that cell.
+        Edges are opened for the players exactly like MineFieldGenerator.generate_from_minemap does.
+        '''
+        if players not in (2, 4):
+            raise Exception("Invalid number of players!")
+        if len(minemap) != x * y:
+            raise ValueError("Number of data does not match the dimensions!")
+
+        if numpy is not None:
+            cells, numbers = cls._cells_and_numbers_numpy(minemap, x, y)
+        else:
+            cells, numbers = cls._cells_and_numbers_python(minemap, x, y)
+
+        # Open up edges. Later edges overwrite the corners of earlier ones.
+        edges_L = slice(0, y)
+        edges_R = slice((x - 1) * y, x * y)
+        edges_U = slice(y, x * y, y)
+        edges_D = slice(y - 1, (x - 1) * y, y)
+
+        if players == 2:
+            edges = ((edges_L, 1), (edges_R, 2))
+        else:
+            edges = ((edges_L, 1), (edges_R, 4), (edges_U, 2), (edges_D, 3))
+        if x > 0 and y > 0:
+            for edge, owner in edges:
+                clickable = _pack(CellState.clickable, owner, False)
+                if numpy is not None:
+                    cells[edge] = (cells[edge] & _MINE_BIT) | clickable
+                else:
+                    cells[edge] = bytes([(b & _MINE_BIT) | clickable for b in cells[edge]])
+
+        cells = bytes(cells)
+        numbers = bytes(numbers)
+        # Label the zero regions now, once for the whole game
+        regions = zero_regions(x, y, numbers, cells.translate(_MINE_TABLE))
+
+        # Nothing is clicked yet, so there are no scores to count.
+        # The hash is computed once here, every later state updates it incrementally.
+        return PackedMineFieldState(x, y, _split_chunks(cells, _chunk_length(y)), numbers,
+                                    scores={}, regions=regions, zobrist=zobrist_hash(cells))
+
+    @classmethod
+    def _cells_and_numbers_numpy(cls, minemap, x, y):
+        if isinstance(minemap, numpy.ndarray):
+            mines = minemap.astype(bool)
+        else:
+            mines = numpy.frombuffer(bytes(minemap), dtype=numpy.uint8) != 0
+        mines = mines.reshape((x, y)).astype(numpy.uint8)
+
+        # 3x3 convolution, minus the center: sum of the 8 shifted copies of the padded mine map
+        padded = numpy.zeros((x + 2, y + 2), dtype=numpy.uint8)
+        padded[1:-1, 1:-1] = mines
+        numbers = numpy.zeros((x, y), dtype=numpy.uint8)
+        for dx in (0, 1, 2):
+            for dy in (0, 1, 2):
+                if dx == 1 and dy == 1:
+                    continue
+                numbers += padded[dx:dx + x, dy:dy + y]
+
+        cells = (mines * _MINE_BIT).ravel()  # all locked, owned by no one
+        return cells, numbers.ravel().tobytes()
+
+    @classmethod
+    def _cells_and_numbers_python(cls, minemap, x, y):
+        mines = [1 if i else 0 for i in minemap]
+
+        # Sum the mines of each 3x3 block as a row sum of 3, then a column sum of 3, and take away the cell itself
+        rows = [mines[row * y:(row + 1) * y] for row in range(x)]
+        sums = [[a + b + c for a, b, c in zip([0] + row[:-1], row, row[1:] + [0])] for row in rows]
+        empty = [0] * y
+
+        numbers = bytearray()
+        for row in range(x):
+            above = sums[row - 1] if row > 0 else empty
+            below = sums[row + 1] if row + 1 < x else empty
+            numbers += bytes([a + b + c - own for a, b, c, own in zip(above, sums[row], below, rows[row])])
+
+        cells = bytearray([_MINE_BIT if mine else 0 for mine in mines])  # all locked, owned by no one
+        return cells, numbers
@@ -0,0 +1,127 @@
+'''
+Compact, versioned wire format for minefield snapshots.
+
+MineFieldState.to_bytes() uses two bytes per cell. But the adjacent mine numbers are fully
+determined by where the mines are, and the packed cell byte (see common.packed_mines) already has the mine bit,
+so a snapshot only needs the packed cell bytes: one byte per cell.
+The decoder computes the numbers again from the mines.
+
+Format:
+    [0]    version (SNAPSHOT_VERSION)
+    [1]    compression (COMPRESSION_*)
+    [2..4) x, big endian
+    [4..6) y, big endian
+    [6...  the x*y packed cell bytes, compressed as the header says:
+             COMPRESSION_NONE: as is
+             COMPRESSION_RLE:  (run length 1~255, cell byte) pairs
+             COMPRESSION_ZLIB: zlib stream
+
+Patches (the cells changed between two states) are encoded as:
+    [0..4)  count, big endian
+    [4...   count flat indices, 4 bytes each, big endian
+    [...    count packed cell bytes, in the same order
+'''
+import itertools
+import struct
+import zlib
+
+SNAPSHOT_VERSION = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_RLE = 1
+COMPRESSION_ZLIB = 2
+
+_HEADER = struct.Struct(">BBHH")
+_PATCH_HEADER = struct.Struct(">I")
+
+# Largest x or y the header can hold
+MAX_DIMENSION = 0xFFFF
+
+
+class SnapshotFormatException(Exception):
+    pass
+
+
+def _rle_encode(cells):
+    result = bytearray()
+    for value, run in itertools.groupby(cells):
+        length = sum(1 for _ in run)
+        while length > 0:
+            result += bytes((min(length, 255), value))
+            length -= 255
+    return bytes(result)
+
+
+def _rle_decode(data):
+    return b"".join(bytes((value,)) * length for length, value in zip(data[0::2], data[1::2]))
+
+
+def encode(x, y, cells, compression=COMPRESSION_NONE):
+    '''
+    cells: bytes-like, the x*y packed cell bytes
+    returns: the snapshot bytes
+    '''
+    if len(cells) != x * y:
+        raise ValueError("Number of data does not match the dimensions!")
+    if x > MAX_DIMENSION or y > MAX_DIMENSION:
+        raise ValueError("A {}x{} field is too big for a snapshot!".format(x, y))
+    if compression == COMPRESSION_NONE:
+        body = bytes(cells)
+    elif compression == COMPRESSION_RLE:
+        body = _rle_encode(cells)
+    elif compression == COMPRESSION_ZLIB:
+        body = zlib.compress(cells, 1)
+    else:
+        raise ValueError("Unknown compression {}".format(compression))
+    return _HEADER.pack(SNAPSHOT_VERSION, compression, x, y) + body
+
+
+def decode(b):
+    '''
+    returns: (x, y, cells) where cells is bytes, the x*y packed cell bytes
+    '''
+    if len(b) < _HEADER.size:
+        raise SnapshotFormatException("Snapshot too short")
+    version, compression, x, y = _HEADER.unpack_from(b)
+    if version != SNAPSHOT_VERSION:
+        raise SnapshotFormatException("Unsupported snapshot version {}".format(version))
+
+    body = b[_HEADER.size:]
+    if compression == COMPRESSION_NONE:
+        cells = bytes(body)
+    elif compression == COMPRESSION_RLE:
+        cells = _rle_decode(body)
+    elif compression == COMPRESSION_ZLIB:
+        cells = zlib.decompress(body)
+    else:
+        raise SnapshotFormatException("Unknown compression {}".format(compression))
+
+    if len(cells) != x * y:
+        raise SnapshotFormatException("Only {} cells in a {}x{} snapshot?".format(len(cells), x, y))
+    return x, y, cells
+
+
+def encode_patch(indices, cells):
+    '''
+    indices: sequence of flat indices
+    cells: bytes-like, the new packed cell byte of each index
+    returns: the patch bytes
+    '''
+    if len(indices) != len(cells):
+        raise ValueError("Number of indices does not match the number of cells!")
+    count = len(indices)
+    return b"".join((_PATCH_HEADER.pack(count), struct.pack(">{}I".format(count), *indices), bytes(cells)))
+
+
+def decode_patch(b):
+    '''
+    returns: (indices, cells) - a tuple of flat indices and the bytes of their new packed cells
+    '''
+    if len(b) < _PATCH_HEADER.size:
+        raise SnapshotFormatException("Patch too short")
+    count, = _PATCH_HEADER.unpack_from(b)
+    if len(b) != _PATCH_HEADER.size + count * 5:
+        raise SnapshotFormatException("Patch of {} cells is {} bytes long?".format(count, len(b)))
+    indices = struct.unpack_from(">{}I".format(count), b, _PATCH_HEADER.size)
+    cells = bytes(b[_PATCH_HEADER.size + count * 4:])
+    return indices, cells
@@ -0,0 +1,599 @@
+'''
+Tiled, lazily generated minefields, for boards too big to allocate up front.
+
+The field is split into square tiles of TileSource.tile_size cells.
+A tile's mines and numbers are never stored with the board: they are a pure function
+of the room seed and the cell coordinates (see TileSource.is_mine),
+so any tile can be generated on first touch, and tiles generated independently always agree across their borders.
+Generated tiles are kept in a small cache and are simply generated again after being evicted.
+Whole-field scans (snapshots) do not go through that cache: TileSource.field() generates the whole field at once,
+with NumPy when it is installed.
+
+TiledMineFieldState only stores the tiles whose cells differ from their freshly generated state.
+Untouched tiles cost no memory, and creating a field only looks at its edges, whatever its size.
+Cells use the same packed byte layout as common.packed_mines,
+and the state exposes the same interface as common.mines.MineFieldState.
+'''
+import collections
+import random
+import threading
+
+from common import snapshot
+from common.mines import CellState, ImmutableCell
+from common.packed_mines import _pack, _cell_score, _is_unopened_safe, _mix64, _zobrist_key, zobrist_hash, \
+    PackedMineFieldGenerator, _STATE_MASK, _OWNER_MASK, _OWNER_SHIFT, _MINE_BIT, _NON_MINE_MASK, _MASK64
+from util import multiarray
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Boards with at least this many cells are created as tiled boards by the server.
+# Smaller boards are cheap enough to create whole, and every join or resync needs the whole field anyway.
+TILED_BOARD_MIN_CELLS = 1 << 22
+
+DEFAULT_TILE_SIZE = 64
+
+# Number of generated tiles each TileSource keeps around.
+_TILE_CACHE_SIZE = 256
+
+class TileSource:
+    '''
+    Everything needed to generate any tile of a board: dimensions, mine ratio, players and seed.
+    A TileSource is shared by every state of a game.
+
+    Mines are point-symmetrical around the center of the field, like the other generators:
+    each cell and its mirror share one roll of the hash.
+    '''
+    def __init__(self, x, y, ratio, players, seed, tile_size=DEFAULT_TILE_SIZE):
+        if players not in (2, 4):
+            raise Exception("Invalid number of players!")
+        if tile_size < 1:
+            raise ValueError("Invalid tile size!")
+        self.x = x
+        self.y = y
+        self.players = players
+        self.seed = random.Random(seed).getrandbits(64)
+        self.tile_size = tile_size
+        self.tiles_x = -(-x // tile_size)
+        self.tiles_y = -(-y // tile_size)
+        self._threshold = int(min(max(ratio, 0.0), 1.0) * (1 << 64))
+        # States of one game are used from several connection threads at once
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def is_mine(self, cx, cy):
+        idx = cx * self.y + cy
+        canonical = min(idx, self.x * self.y - 1 - idx)
+        return _mix64((self.seed + canonical * 0x9E3779B97F4A7C15) & _MASK64) < self._threshold
+
+    def _mine_map(self):
+        # bytes, nonzero for mines, of the whole field. Only the first half is rolled; the rest is its mirror
+        n = self.x * self.y
+        half = (n + 1) // 2
+        if numpy is not None:
+            u64 = numpy.uint64
+            z = numpy.arange(half, dtype=u64) * u64(0x9E3779B97F4A7C15) + u64(self.seed)
+            z = (z ^ (z >> u64(30))) * u64(0xBF58476D1CE4E5B9)
+            z = (z ^ (z >> u64(27))) * u64(0x94D049BB133111EB)
+            z ^= z >> u64(31)
+            if self._threshold > _MASK64:
+                rolls = numpy.ones(half, dtype=numpy.uint8)
+            else:
+                rolls = (z < u64(self._threshold)).astype(numpy.uint8)
+            return numpy.concatenate((rolls, rolls[:n // 2][::-1])).tobytes()
+
+        rolls = bytes(_mix64((self.seed + canonical * 0x9E3779B97F4A7C15) & _MASK64) < self._threshold
+                      for canonical in range(half))
+        return rolls + rolls[:n // 2][::-1]
+
+    def field(self):
+        '''
+        The freshly generated cells and numbers of the whole field: (cells, numbers),
+        bytearrays in the same layout as PackedMineFieldState.
+        O(size of the field), but much cheaper than generating every tile, and leaves the tile cache alone.
+        '''
+        mines = self._mine_map()
+        if numpy is not None:
+            cells, numbers = PackedMineFieldGenerator._cells_and_numbers_numpy(mines, self.x, self.y)
+            cells = bytearray(cells.tobytes())
+        else:
+            cells, numbers = PackedMineFieldGenerator._cells_and_numbers_python(mines, self.x, self.y)
+        for cx, cy, owner in self._edge_cells():
+            idx = cx * self.y + cy
+            cells[idx] = _pack(CellState.clickable, owner, mines[idx])
+        return cells, bytearray(numbers)
+
+    def _edge_owner(self, cx, cy):
+        '''
+        The player whose starting edge (cx,cy) is on, or 0.
+        Same edges (and corners) as PackedMineFieldGenerator.generate_from_minemap.
+        '''
+        owner = 0
+        if self.players == 2:
+            if cx == 0:
+                owner = 1
+            if cx == self.x - 1:
+                owner = 2
+        else:
+            if cx == 0:
+                owner = 1
+            if cx == self.x - 1:
+                owner = 4
+            if cy == 0 and cx >= 1:
+                owner = 2
+            if cy == self.y - 1 and cx <= self.x - 2:
+                owner = 3
+        return owner
+
+    def _edge_cells(self):
+        '''
+        (cx, cy, owner) of every cell on a starting edge. These are the only cells that start out clickable.
+        '''
+        edges = set()
+        for cx in {0, self.x - 1}:
+            edges.update((cx, cy) for cy in range(self.y))
+        if self.players == 4:
+            for cy in {0, self.y - 1}:
+                edges.update((cx, cy) for cx in range(self.x))
+
+        for cx, cy in edges:
+            owner = self._edge_owner(cx, cy)
+            if owner:
+                yield cx, cy, owner
+
+    def edge_hash(self):
+        '''
+        The state_hash() of the freshly generated field. O(x+y).
+        Only the starting edges are not locked and unowned, so only they count. (see packed_mines.zobrist_hash)
+        '''
+        h = 0
+        for cx, cy, owner in self._edge_cells():
+            idx = cx * self.y + cy
+            mine = _MINE_BIT if self.is_mine(cx, cy) else 0
+            h ^= _zobrist_key(idx, _pack(CellState.clickable, owner, mine)) ^ _zobrist_key(idx, mine)
+        return h
+
+    def tile_bounds(self, key):
+        '''
+        returns: (x0, y0, width, height) of the tile with the given key
+        '''
+        tx, ty = divmod(key, self.tiles_y)
+        x0 = tx * self.tile_size
+        y0 = ty * self.tile_size
+        return x0, y0, min(self.tile_size, self.x - x0), min(self.tile_size, self.y - y0)
+
+    def tile(self, key):
+        '''
+        The freshly generated tile: (cells, numbers, unopened)
+          cells, numbers: bytes, in the same layout as PackedMineFieldState, local to the tile
+                          (the local index of (lx,ly) is lx*height+ly)
+          unopened: the number of unopened non-mine cells for each owner (a tuple of 8 ints)
+        '''
+        with self._cache_lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+                return result
+
+        x0, y0, w, h = self.tile_bounds(key)
+
+        # Mines of the tile and the ring of cells around it, clipped to the field
+        hx0, hy0 = max(x0 - 1, 0), max(y0 - 1, 0)
+        hx1, hy1 = min(x0 + w + 1, self.x), min(y0 + h + 1, self.y)
+        hh = hy1 - hy0
+        halo = [self.is_mine(cx, cy) for cx in range(hx0, hx1) for cy in range(hy0, hy1)]
+
+        cells = bytearray(w * h)
+        numbers = bytearray(w * h)
+        unopened = [0] * 8
+        i = 0
+        for cx in range(x0, x0 + w):
+            for cy in range(y0, y0 + h):
+                count = 0
+                for nx in range(max(cx - 1, hx0), min(cx + 2, hx1)):
+                    base = (nx - hx0) * hh - hy0
+                    for ny in range(max(cy - 1, hy0), min(cy + 2, hy1)):
+                        if (nx != cx or ny != cy) and halo[base + ny]:
+                            count += 1
+                numbers[i] = count
+
+                mine = halo[(cx - hx0) * hh + cy - hy0]
+                owner = self._edge_owner(cx, cy)
+                state = CellState.clickable if owner else CellState.locked
+                cells[i] = _pack(state, owner, mine)
+                if not mine:
+                    unopened[owner] += 1
+                i += 1
+
+        result = (bytes(cells), bytes(numbers), tuple(unopened))
+        # Generated outside the lock: two threads may both generate the same tile, and get equal results
+        with self._cache_lock:
+            self._cache[key] = result
+            if len(self._cache) > _TILE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+
+class _TileBuffer:
+    '''
+    Copy-on-write view of the cells of a TiledMineFieldState, addressed by coordinates.
+    A tile is copied the first time one of its cells is written.
+    '''
+    def __init__(self, source, tiles):
+        self._source = source
+        self._tiles = tiles
+        self._modified = dict()  # tile key -> bytearray
+        self._original = dict()  # flat index -> original cell byte
+
+    def _locate(self, cx, cy):
+        source = self._source
+        tx, lx = divmod(cx, source.tile_size)
+        ty, ly = divmod(cy, source.tile_size)
+        key = tx * source.tiles_y + ty
+        height = min(source.tile_size, source.y - ty * source.tile_size)
+        return key, lx * height + ly
+
+    def _tile_cells(self, key):
+        if key in self._modified:
+            return self._modified[key]
+        if key in self._tiles:
+            return self._tiles[key]
+        return self._source.tile(key)[0]
+
+    def get(self, cx, cy):
+        key, local = self._locate(cx, cy)
+        return self._tile_cells(key)[local]
+
+    def number(self, cx, cy):
+        key, local = self._locate(cx, cy)
+        return self._source.tile(key)[1][local]
+
+    def set(self, cx, cy, value):
+        key, local = self._locate(cx, cy)
+        if key not in self._modified:
+            self._modified[key] = bytearray(self._tile_cells(key))
+        tile = self._modified[key]
+        idx = cx * self._source.y + cy
+        if idx not in self._original:
+            self._original[idx] = tile[local]
+        tile[local] = value
+
+    def changes(self):
+        '''
+        returns: list of (flat index, old byte, new byte) for every cell whose value changed
+        '''
+        result = []
+        for idx, old in self._original.items():
+            new = self.get(*divmod(idx, self._source.y))
+            if new != old:
+                result.append((idx, old, new))
+        return result
+
+    def freeze(self):
+        '''
+        returns: (tile dict for the new state, keys of the tiles that were not stored before)
+        '''
+        tiles = dict(self._tiles)
+        new_keys = [key for key in self._modified if key not in self._tiles]
+        for key, tile in self._modified.items():
+            tiles[key] = bytes(tile)
+        return tiles, new_keys
+
+
+class TiledMineFieldState:
+    '''
+    An IMMUTABLE minefield, made of lazily generated tiles.
+    Exposes the same interface as common.mines.MineFieldState;
+    indexing a TiledMineFieldState returns an ImmutableCell.
+
+    Flat indices are the same as everywhere else: the flat index of (x,y) is x*size_y+y.
+    '''
+
+    @classmethod
+    def to_bytes(cls, mfs):
+        '''
+        Same format as MineFieldState.to_bytes. This generates the whole field (see TileSource.field), so it is O(size of the field).
+        '''
+        cells, numbers = mfs._flat_cells_and_numbers()
+
+        result = bytearray()
+        result += int(mfs.x).to_bytes(2, "big")
+        result += int(mfs.y).to_bytes(2, "big")
+        cell_data_bytes = bytearray(len(cells) * 2)
+        cell_data_bytes[0::2] = cells
+        cell_data_bytes[1::2] = numbers
+        result += cell_data_bytes
+        return bytes(result)
+
+    @classmethod
+    def to_compact_bytes(cls, mfs, compression=snapshot.COMPRESSION_NONE):
+        '''
+        Same as PackedMineFieldState.to_compact_bytes. Also O(size of the field).
+        '''
+        cells, _ = mfs._flat_cells_and_numbers()
+        return snapshot.encode(mfs.x, mfs.y, cells, compression)
+
+    def _flat_cells_and_numbers(self):
+        '''
+        returns: (cells, numbers) of the whole field as bytearrays, in the same layout as PackedMineFieldState
+        The freshly generated field, with the stored tiles copied over it.
+        '''
+        source = self._source
+        cells, numbers = source.field()
+        for key, tile_cells in self._tiles.items():
+            x0, y0, w, h = source.tile_bounds(key)
+            for lx in range(w):
+                start = (x0 + lx) * source.y + y0
+                cells[start:start + h] = tile_cells[lx * h:(lx + 1) * h]
+        return cells, numbers
+
+    def __init__(self, source, tiles=None, scores=None, unopened=None, version=0, zobrist=None):
+        '''
+        source:   the TileSource of this field
+        tiles:    dict of tile key -> bytes, the cells of every tile that differs from its generated state.
+                  May be shared with other states, so it must never be modified.
+        scores:   the score ledger (see calculate_scores)
+        unopened: the number of unopened non-mine cells for each owner, in the stored tiles only
+        version:  the number of inputs applied since the board was generated
+        zobrist:  the state_hash() of this field, if already known
+        '''
+        self._source = source
+        self._tiles = tiles if tiles is not None else dict()
+        self._scores = scores if scores is not None else dict()
+        self._unopened = unopened if unopened is not None else [0] * 8
+        self._version = version
+        self._zobrist = zobrist
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def dimensions(self):
+        return (self._source.x, self._source.y)
+    @property
+    def x(self):
+        return self._source.x
+    @property
+    def y(self):
+        return self._source.y
+
+    def __iter__(self):
+        return self.indices()
+    def indices(self):
+        for cx in range(self._source.x):
+            for cy in range(self._source.y):
+                yield (cx, cy)
+
+    def _check_coords(self, coords):
+        cx, cy = coords
+        if cx < 0 or cx >= self._source.x or cy < 0 or cy >= self._source.y:
+            raise multiarray.InvalidCoordinatesException(
+                "Received {} in a {}x{} field!".format(coords, self._source.x, self._source.y))
+
+    def _tile_cells(self, key):
+        if key in self._tiles:
+            return self._tiles[key]
+        return self._source.tile(key)[0]
+
+    def __getitem__(self, key):
+        self._check_coords(key)
+        buffer = _TileBuffer(self._source, self._tiles)
+        return ImmutableCell.from_packed(buffer.get(*key), buffer.number(*key))
+
+    def index_to_coords(self, idx):
+        return divmod(idx, self._source.y)
+
+    def state_hash(self):
+        '''
+        Same as PackedMineFieldState.state_hash.
+        Generated fields start from TileSource.edge_hash(), and every input updates it from the changed cells,
+        so no tile is generated for it. Only a state created without a known hash has to generate the whole field, once.
+        '''
+        if self._zobrist is None:
+            self._zobrist = zobrist_hash(self._flat_cells_and_numbers()[0])
+        return self._zobrist
+
+    def cell_bytes(self, indices):
+        '''
+        Same as PackedMineFieldState.cell_bytes
+        '''
+        buffer = _TileBuffer(self._source, self._tiles)
+        return bytes(buffer.get(*divmod(idx, self._source.y)) for idx in indices)
+
+    def process_input(self, mfi, return_changes=False):
+        '''
+        Processes user input defined by MineFieldInput mfi
+        then returns a new TiledMineFieldState object that results from that input.
+        return_changes works like in PackedMineFieldState.process_input.
+        '''
+        return self.process_inputs((mfi,), return_changes)
+
+    def process_inputs(self, mfis, return_changes=False):
+        '''
+        Processes every MineFieldInput in the iterable mfis, in order,
+        then returns the new TiledMineFieldState object that results from all of them.
+        '''
+        buffer = _TileBuffer(self._source, self._tiles)
+        inputs = 0
+        for mfi in mfis:
+            inputs += 1
+            self._check_coords((mfi.x, mfi.y))
+            if mfi.button == 1:
+                self._uncover(buffer, mfi.x, mfi.y, mfi.player_index)
+            elif mfi.button == 2:
+                self._flag(buffer, mfi.x, mfi.y, mfi.player_index)
+            elif mfi.button == 3:
+                self._superclick(buffer, mfi.x, mfi.y, mfi.player_index)
+
+        changes = buffer.changes()
+        tiles, new_keys = buffer.freeze()
+
+        scores = dict(self._scores)
+        unopened = list(self._unopened)
+        zobrist = self._zobrist
+        for key in new_keys:
+            for owner, count in enumerate(self._source.tile(key)[2]):
+                unopened[owner] += count
+        for idx, old, new in changes:
+            number = buffer.number(*divmod(idx, self._source.y))
+            if zobrist is not None:
+                zobrist ^= _zobrist_key(idx, old) ^ _zobrist_key(idx, new)
+            if _is_unopened_safe(old):
+                unopened[(old & _OWNER_MASK) >> _OWNER_SHIFT] -= 1
+            if _is_unopened_safe(new):
+                unopened[(new & _OWNER_MASK) >> _OWNER_SHIFT] += 1
+
+            old_score = _cell_score(old, number)
+            if old_score is not None:
+                scores[old_score[0]] -= old_score[1]
+            new_score = _cell_score(new, number)
+            if new_score is not None:
+                scores[new_score[0]] = scores.get(new_score[0], 0) + new_score[1]
+
+        newstate = TiledMineFieldState(self._source, tiles, scores, unopened, self._version + inputs, zobrist)
+        if return_changes:
+            return newstate, sorted([change[0] for change in changes])
+        return newstate
+
+    def __eq__(self, other):
+        if not isinstance(other, TiledMineFieldState):
+            return NotImplemented
+        if self._source is not other._source:
+            return self.to_bytes(self) == other.to_bytes(other)
+        return not self.changed_indices(other)
+
+    __hash__ = None
+
+    def changed_indices(self, other):
+        '''
+        Sorted flat indices of every cell that differs between this state and other. (same TileSource)
+        Only the stored tiles are looked at.
+        '''
+        if self._source is not other._source:
+            raise ValueError("Cannot compare fields of different boards!")
+        source = self._source
+        result = []
+        for key in set(self._tiles) | set(other._tiles):
+            mine = self._tile_cells(key)
+            theirs = other._tile_cells(key)
+            if mine is theirs or mine == theirs:
+                continue
+            x0, y0, w, h = source.tile_bounds(key)
+            for local in range(w * h):
+                if mine[local] != theirs[local]:
+                    lx, ly = divmod(local, h)
+                    result.append((x0 + lx) * source.y + y0 + ly)
+        result.sort()
+        return result
+
+    def calculate_scores(self):
+        '''
+        returns: dict of player_index -> score
+        Untouched tiles never have clicked cells, so the ledger of the stored tiles is the whole score.
+        '''
+        return dict(self._scores)
+
+    def check_all_opened(self, player_filter=(1, 2, 3, 4)):
+        '''
+        Are all non-mine cells that are unowned or owned by a player in player_filter clicked?
+        Untouched tiles are only generated until one with an unopened cell is found,
+        which is almost always the first one.
+        '''
+        owners = set(player_filter)
+        owners.add(0)
+        owners = [owner for owner in owners if 0 <= owner < 8]
+
+        if sum(self._unopened[owner] for owner in owners):
+            return False
+        for key in range(self._source.tiles_x * self._source.tiles_y):
+            if key not in self._tiles:
+                unopened = self._source.tile(key)[2]
+                if sum(unopened[owner] for owner in owners):
+                    return False
+        return True
+
+    def _neighbors(self, cx, cy):
+        for nx in range(max(cx - 1, 0), min(cx + 2, self._source.x)):
+            for ny in range(max(cy - 1, 0), min(cy + 2, self._source.y)):
+                if nx != cx or ny != cy:
+                    yield nx, ny
+
+    def _superclick(self, cells, cx, cy, player_index):
+        '''
+        Superclick (left+right)
+        '''
+        neighbors = list(self._neighbors(cx, cy))
+
+        minecount = 0
+        for nx, ny in neighbors:
+            b = cells.get(nx, ny)
+            if b & _STATE_MASK == CellState.flagged:
+                minecount += 1
+            elif b & _STATE_MASK == CellState.clicked and b & _MINE_BIT:
+                minecount += 1
+
+        if minecount == cells.number(cx, cy):
+            for nx, ny in neighbors:
+                self._uncover(cells, nx, ny, player_index)
+
+    def _flag(self, cells, cx, cy, player_index):
+        '''
+        Place a flag
+        '''
+        b = cells.get(cx, cy)
+        if b & _STATE_MASK == CellState.flagged:
+            if (b & _OWNER_MASK) >> _OWNER_SHIFT == player_index:
+                cells.set(cx, cy, (b & ~_STATE_MASK) | CellState.clickable)
+
+        elif b & _NON_MINE_MASK == _pack(CellState.clickable, player_index, False):
+            cells.set(cx, cy, (b & ~_STATE_MASK) | CellState.flagged)
+
+    def _uncover(self, cells, initial_x, initial_y, player_index):
+        '''
+        Uncover a cell, expanding outwards if possible.
+        Tiles are generated (and copied) as the fill reaches them.
+        '''
+        clickable = _pack(CellState.clickable, player_index, False)
+        clicked = _pack(CellState.clicked, player_index, False)
+
+        uncover_queue = collections.deque(((initial_x, initial_y),))
+        queued = {(initial_x, initial_y)}  # every cell is queued at most once
+
+        while uncover_queue:
+            cx, cy = uncover_queue.popleft()
+            b = cells.get(cx, cy)
+            if b & _NON_MINE_MASK != clickable:
+                continue
+
+            cells.set(cx, cy, clicked | (b & _MINE_BIT))
+            autoclick = cells.number(cx, cy) == 0 and not b & _MINE_BIT
+
+            for neighbor in self._neighbors(cx, cy):
+                nb = cells.get(*neighbor)
+                if nb & _STATE_MASK == CellState.locked:
+                    cells.set(*neighbor, clickable | (nb & _MINE_BIT))
+                if autoclick and neighbor not in queued:
+                    uncover_queue.append(neighbor)
+                    queued.add(neighbor)
+
+
+class TiledMineFieldGenerator:
+    '''
+    Creates TiledMineFieldStates. Nothing is generated until a tile is first touched:
+    creating a field only hashes its starting edges.
+    '''
+
+    @classmethod
+    def generate_symmetrical(cls, x, y, ratio, players, seed=None, tile_size=DEFAULT_TILE_SIZE):
+        '''
+        Generate a symmetrical minefield.
+        Every mirrored pair of cells is rolled independently, like PackedMineFieldGenerator.generate_symmetrical.
+        seed: if given, the same seed always generates the same field. Random if None.
+        '''
+        if seed is None:
+            seed = random.getrandbits(64)
+        source = TileSource(x, y, ratio, players, seed, tile_size)
+        return TiledMineFieldState(source, zobrist=source.edge_hash())
@@ -6,11 +6,22 @@ DEFAULT_PORT = 19477
 if len(sys.argv)>1 and sys.argv[1]=="-server":
 
     port = DEFAULT_PORT
-    if len(sys.argv) > 2 and sys.argv[2].startswith("--port="):
-        port = int(sys.argv[2][7:])
+    use_asyncio = False
+    for arg in sys.argv[2:]:
+        if arg.startswith("--port="):
+            port = int(arg[7:])
+        elif arg == "--selector":
+            # One selectors/epoll thread for all connections, instead of threads per connection
+            from network import async_socket
+            async_socket.set_backend(async_socket.BACKEND_SELECTOR)
+        elif arg == "--asyncio":
+            use_asyncio = True
 
     import server.server_dispatcher
-    server.server_dispatcher.start_server(port=port,host='')
+    if use_asyncio:
+        server.server_dispatcher.start_server_asyncio(port=port,host='')
+    else:
+        server.server_dispatcher.start_server(port=port,host='')
 
 else:
     import client.client_ui
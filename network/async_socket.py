@@ -13,30 +13,68 @@ start_server(new_connection_handler, host, port)
 initiate_connection()
     connects to a host that has start_server() running. Returns a AsyncSocket.
 
+set_backend(backend)
+    BACKEND_THREADS (default): a reading thread and a writing thread per connection.
+    BACKEND_SELECTOR: all connections and listeners on one selectors/epoll thread. See network.selector_socket.
+    start_server(), end_server() and initiate_connection() use the backend that is set when they are called.
+
 For using the AsyncSocket class itself, refer to its own docstring.
 '''
+import collections
+import itertools
 import threading
 import socket
+import time
 import traceback
 
+from network import tracing
+from network.tracing import trace
+
 class DeadSocketException(Exception):
     pass
 
+# Most buffers handed to a single sendmsg() call. (IOV_MAX is at least 1024 on the usual platforms)
+_MAX_BUFFERS_PER_SEND = 512
+# A peer that lets this much data pile up in its queue is not reading it. It gets disconnected.
+MAX_PENDING_BYTES = 64 << 20
+# How long kill_socket() keeps trying to get the already queued data out before closing
+KILL_FLUSH_TIMEOUT = 5.0
+
+BACKEND_THREADS = "threads"
+BACKEND_SELECTOR = "selector"
+_backend = BACKEND_THREADS
+
+def set_backend(backend):
+    global _backend
+    if backend not in (BACKEND_THREADS, BACKEND_SELECTOR):
+        raise Exception("Unknown backend {}".format(backend))
+    _backend = backend
+
+def _selector_backend():
+    # Imported here - selector_socket builds on this module
+    from network import selector_socket
+    return selector_socket
+
 class AsyncSocket:
     '''
     It's like a socket, but asynchronous.
     There are 4 actions you can take with an instance of this class:
      - send_data(data)
        Send a bytes() object through the socket.
+       (or send_buffers(buffers), to send several bytes-like objects back to back without joining them)
      - add_data_receive_callback(callback)
        Register a callback to be called every time this socket receives new data
      - add_connection_error_callback(callback)
        Register a callback to be called when an error occurs.
      - add_connection_close_callback(callback)
        Register a callback to be called when this socket dies.
+
+    Sending never blocks: the data is queued, and a writer thread per connection sends it.
+    Whatever is in the queue at that time goes out in one scatter-gather sendmsg() call,
+    so a slow peer only slows down its own writer, never the thread that produced the data.
     '''
     def __init__(self, sock, addr, port):
-        print("\nAsyncSocket initialized:",addr,port)
+        trace(tracing.INFO, "\nAsyncSocket initialized: {} {}", addr, port)
         self._addr=addr
         self._port=port
         self._sock=sock
@@ -48,6 +86,11 @@ class AsyncSocket:
 
         self._alive=True
 
+        # Outbound queue of memoryviews, drained by _writer_loop()
+        self._send_queue=collections.deque()
+        self._send_queue_bytes=0
+        self._send_cond=threading.Condition()
+
     @property
     def alive(self):
         return self._alive
@@ -66,14 +109,16 @@ class AsyncSocket:
         for i in self._error_callbacks:
             i(err)
 
-    def _call_recv_callbacks(self,data):
-        '''
-        print("AsyncSocket received data")
-        print(" |From:",self._addr,self._port)
+    @classmethod
+    def _data_dump(cls, data):
         dat = str(data)
         if len(dat) > 250:
-            dat = "(blob, {} bytes)".format(len(dat))
-        print(" |Data: " + dat)'''
+            dat = "(blob, {} bytes)".format(len(data))
+        return dat
+
+    def _call_recv_callbacks(self,data):
+        trace(tracing.RAW, "AsyncSocket received data\n |From: {} {}\n |Data: {}",
+              self._addr, self._port, tracing.Lazy(lambda: self._data_dump(data)))
 
         for i in self._recv_callbacks:
             try:
@@ -87,23 +132,107 @@ class AsyncSocket:
         for i in self._close_callbacks:
             i()
 
+    @property
+    def pending_bytes(self):
+        '''
+        Number of bytes queued, but not sent yet.
+        '''
+        return self._send_queue_bytes
+
     def kill_socket(self):
-        print("Killing socket on",self._addr,self._port)
-        self._sock.close()
-        self._alive=False
+        trace(tracing.INFO, "Killing socket on {} {}", self._addr, self._port)
+        # The writer sends what was queued before this (for up to KILL_FLUSH_TIMEOUT) and closes the socket
+        with self._send_cond:
+            self._alive=False
+            self._wake_writer()
 
     def send_data(self, data):
+        self.send_buffers((data,))
+
+    def send_buffers(self, buffers):
+        '''
+        Queue some bytes-like objects to be sent back to back.
+        They are sent as they are, without being copied into one,
+        and nothing sent from another thread can end up in between them.
+        The objects must not be modified afterwards.
         '''
-        print("AsyncSocket is sending data")
-        print(" |To:", self._addr, self._port)
-        dat=str(data)
-        if len(dat)>250:
-            dat="(blob, {} bytes)".format(len(dat))
-        print(" |Data: " + dat)'''
-        if not self._alive:
-            raise DeadSocketException("This socket's dead bro")
+        trace(tracing.RAW, "AsyncSocket is sending data\n |To: {} {}\n |Data: {}",
+              self._addr, self._port, tracing.Lazy(lambda: self._data_dump(b"".join(buffers))))
+        views=[memoryview(i).cast("B") for i in buffers]
+        with self._send_cond:
+            if not self._alive:
+                raise DeadSocketException("This socket's dead bro")
+
+            self._send_queue.extend(i for i in views if len(i))
+            self._send_queue_bytes += sum(len(i) for i in views)
+            if self._send_queue_bytes > MAX_PENDING_BYTES:
+                trace(tracing.ERROR, "{} {} is not reading its data. Disconnecting.", self._addr, self._port)
+                self._alive=False
+                self._send_queue.clear()
+            self._wake_writer()
+
+    def _wake_writer(self):
+        # Called with _send_cond held, when there is something new for the writer to do
+        self._send_cond.notify()
+
+    def _consume_sent(self, sent):
+        # Called with _send_cond held: drop the first (sent) bytes from the queue
+        self._send_queue_bytes -= sent
+        while sent:
+            head=self._send_queue[0]
+            if len(head) <= sent:
+                sent -= len(head)
+                self._send_queue.popleft()
+            else:
+                self._send_queue[0]=head[sent:]
+                sent=0
+
+    def _send_some(self, buffers):
+        # Returns the number of bytes sent
+        if hasattr(self._sock, "sendmsg"):
+            return self._sock.sendmsg(buffers)
+        # No scatter-gather (Windows): send the first buffer, the rest goes in the next rounds
+        return self._sock.send(buffers[0])
+
+    def _writer_loop(self):
+        # Should only be called by _start_blob_pipe()
+        deadline=None
+        try:
+            while True:
+                with self._send_cond:
+                    while self._alive and not self._send_queue:
+                        self._send_cond.wait()
+                    if not self._send_queue:
+                        break # Killed, and everything is out
+                    if not self._alive:
+                        if deadline is None:
+                            deadline=time.monotonic() + KILL_FLUSH_TIMEOUT
+                        elif time.monotonic() > deadline:
+                            break
+                    buffers=list(itertools.islice(self._send_queue, _MAX_BUFFERS_PER_SEND))
+
+                try:
+                    sent=self._send_some(buffers)
+                except socket.timeout:
+                    continue # Peer's window is full. Check for kills, and try again
+
+                with self._send_cond:
+                    self._consume_sent(sent)
+
+        except OSError:
+            # The socket's dead - closed here or by the reading thread
+            pass
 
-        self._sock.sendall(data)
+        except Exception as err:
+            trace(tracing.ERROR, '\nError occurred while sending: {}', err)
+            self._call_error_callbacks(err)
+
+        with self._send_cond:
+            self._alive=False
+            self._send_queue.clear()
+            self._send_queue_bytes=0
+        # Wakes the reading thread up, which calls the close callbacks
+        self._sock.close()
 
     def _threading_loop(self):
         # Should only be called by _start_blob_pipe()
@@ -122,29 +251,35 @@ class AsyncSocket:
 
 
         except ConnectionAbortedError:
-            print("ConnectionAbortedError raised")
+            trace(tracing.INFO, "ConnectionAbortedError raised")
             # Normal termination
             pass
 
         except OSError:
-            print("OSError raised")
+            trace(tracing.INFO, "OSError raised")
             # For linux, a dead socket will raise this error
             pass
 
         except Exception as err:
-            print('\nError occurred: ', err)
+            trace(tracing.ERROR, '\nError occurred: {}', err)
             self._call_error_callbacks(err)
 
         self._call_close_callbacks()
-        print("Closing AsyncSocket")
+        trace(tracing.INFO, "Closing AsyncSocket")
+        with self._send_cond:
+            self._alive=False
+            self._send_queue.clear()
+            self._send_cond.notify()
         self._sock.close()
-        self._alive=False
 
 def _start_blob_pipe(sock, addr, port):
     lc=AsyncSocket(sock, addr, port)
     threading.Thread(
         target=lambda:lc._threading_loop()
     ).start()
+    threading.Thread(
+        target=lambda:lc._writer_loop()
+    ).start()
     return lc
 
 _listener_threads=dict()
@@ -166,12 +301,12 @@ class IncomingConnectionListeningThread(threading.Thread):
 
         self._sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        print("\nBind to...", self._host, self._port)
+        trace(tracing.INFO, "\nBind to... {} {}", self._host, self._port)
         self._sock.bind((self._host, self._port))
 
 
     def kill(self):
-        print("Killing...", self._host, self._port)
+        trace(tracing.INFO, "Killing... {} {}", self._host, self._port)
         self._alive=False
         self._sock.close()
 
@@ -188,11 +323,14 @@ class IncomingConnectionListeningThread(threading.Thread):
                 pass
             except OSError:
                 # Usually means the socket is closed
-                print("Killed ", self._host, self._port)
+                trace(tracing.INFO, "Killed {} {}", self._host, self._port)
                 break
 
 _started=False
 def start_server(new_connection_handler, host, port):
+    if _backend == BACKEND_SELECTOR:
+        return _selector_backend().start_server(new_connection_handler, host, port)
+
     global _started
     if _started:
         raise Exception("Cannot start twice!")
@@ -201,11 +339,17 @@ def start_server(new_connection_handler, host, port):
     _accept_connections(new_connection_handler,host,port)
 
 def end_server(host,port):
+    if _backend == BACKEND_SELECTOR:
+        return _selector_backend().end_server(host, port)
+
     if (host, port) in _listener_threads:
         _listener_threads[host,port].kill()
 
 
 def initiate_connection(ip,port):
+    if _backend == BACKEND_SELECTOR:
+        return _selector_backend().initiate_connection(ip, port)
+
     s=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((ip,port))
 
@@ -0,0 +1,167 @@
+'''
+The asyncio version of network.async_socket.
+
+AsyncioSocket is an asyncio.Protocol with the same interface as AsyncSocket,
+so SmartPipe (or AsyncSmartPipe, for awaitable responses) and everything on top of it run on an asyncio event loop,
+without any threads of their own.
+
+start_server(new_connection_handler, host, port)
+    coroutine. Starts a server, the asyncio.start_server() way, but on AsyncioSockets.
+    new_connection_handler: called with the AsyncioSocket of every new connection, on the event loop.
+    Returns the asyncio.Server.
+
+initiate_connection(ip, port)
+    coroutine. Connects to a server. Returns an AsyncioSocket.
+
+The receive, close and error callbacks are all called on the event loop.
+send_data(), send_buffers() and kill_socket() may be called from any thread.
+'''
+import asyncio
+import socket
+import threading
+import traceback
+
+from network import async_socket
+from network import tracing
+from network.tracing import trace
+
+
+class AsyncioSocket(asyncio.Protocol):
+    '''
+    AsyncSocket, as an asyncio.Protocol. Refer to AsyncSocket for the interface.
+    Sending never blocks: the data goes into the transport's buffer, and the event loop sends it.
+    '''
+    def __init__(self, new_connection_handler=None):
+        self._new_connection_handler=new_connection_handler
+        self._transport=None
+        self._loop=None
+        self._loop_thread=None
+        self._addr=None
+        self._port=None
+        self._recv_callbacks=[]
+        self._error_callbacks=[]
+        self._close_callbacks=[]
+        self._alive=False
+        self._killed=False
+
+    @property
+    def alive(self):
+        return self._alive
+    def add_data_receive_callback(self, cb):
+        self._recv_callbacks.append(cb)
+    def remove_data_receive_callback(self,cb):
+        self._recv_callbacks.remove(cb)
+
+    def add_connection_error_callback(self, cb):
+        self._error_callbacks.append(cb)
+
+    def add_connection_close_callback(self, cb):
+        self._close_callbacks.append(cb)
+
+    @property
+    def pending_bytes(self):
+        '''
+        Number of bytes queued, but not sent yet.
+        '''
+        return self._transport.get_write_buffer_size() if self._transport else 0
+
+    def connection_made(self, transport):
+        if self._killed:
+            # Killed before it connected. The close callbacks have run already, in kill_socket()
+            transport.abort()
+            return
+        self._transport=transport
+        self._loop=asyncio.get_running_loop()
+        self._loop_thread=threading.get_ident()
+        self._addr, self._port = transport.get_extra_info("peername")[:2]
+        self._alive=True
+        trace(tracing.INFO, "\nAsyncSocket initialized: {} {}", self._addr, self._port)
+
+        if self._new_connection_handler is not None:
+            self._new_connection_handler(self)
+
+    def data_received(self, data):
+        trace(tracing.RAW, "AsyncSocket received data\n |From: {} {}\n |Data: {}",
+              self._addr, self._port, tracing.Lazy(lambda: async_socket.AsyncSocket._data_dump(data)))
+
+        for i in self._recv_callbacks:
+            try:
+                i(data)
+            except:
+                # Same as AsyncSocket - keep the exception away from the event loop
+                traceback.print_exc()
+
+    def connection_lost(self, exc):
+        self._alive=False
+        if self._transport is None:
+            return # Never connected, see connection_made()
+        if exc is not None and not isinstance(exc, (ConnectionAbortedError, ConnectionResetError)):
+            trace(tracing.ERROR, '\nError occurred: {}', exc)
+            for i in self._error_callbacks:
+                i(exc)
+
+        trace(tracing.INFO, "Closing AsyncSocket")
+        for i in self._close_callbacks:
+            i()
+
+    def _call_in_loop(self, func, *args):
+        if threading.get_ident() == self._loop_thread:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def kill_socket(self):
+        trace(tracing.INFO, "Killing socket on {} {}", self._addr, self._port)
+        self._alive=False
+        if self._transport is None:
+            # Not connected yet, so nothing to flush or close.
+            # Still dead for good: anything waiting on this socket gets told now
+            if self._killed:
+                return
+            self._killed=True
+            trace(tracing.INFO, "Closing AsyncSocket")
+            for i in self._close_callbacks:
+                i()
+            return
+        # close() sends what is already buffered first
+        self._call_in_loop(self._transport.close)
+
+    def send_data(self, data):
+        self.send_buffers((data,))
+
+    def send_buffers(self, buffers):
+        '''
+        Queue some bytes-like objects to be sent back to back, without joining them.
+        The objects must not be modified afterwards.
+        '''
+        trace(tracing.RAW, "AsyncSocket is sending data\n |To: {} {}\n |Data: {}",
+              self._addr, self._port,
+              tracing.Lazy(lambda: async_socket.AsyncSocket._data_dump(b"".join(buffers))))
+        if not self._alive:
+            raise async_socket.DeadSocketException("This socket's dead bro")
+
+        self._call_in_loop(self._write, tuple(buffers))
+
+    def _write(self, buffers):
+        if self._transport.is_closing():
+            return
+        self._transport.writelines(buffers)
+        if self._transport.get_write_buffer_size() > async_socket.MAX_PENDING_BYTES:
+            trace(tracing.ERROR, "{} {} is not reading its data. Disconnecting.", self._addr, self._port)
+            self._alive=False
+            self._transport.abort()
+
+
+async def start_server(new_connection_handler, host, port):
+    loop=asyncio.get_running_loop()
+    trace(tracing.INFO, "\nBind to... {} {}", host, port)
+    # A deep backlog, so thousands of clients connecting at once don't end up retrying SYNs
+    return await loop.create_server(
+        lambda: AsyncioSocket(new_connection_handler), host, port, backlog=socket.SOMAXCONN
+    )
+
+
+async def initiate_connection(ip, port):
+    loop=asyncio.get_running_loop()
+    _, protocol = await loop.create_connection(AsyncioSocket, ip, port)
+    return protocol
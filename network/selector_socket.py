@@ -0,0 +1,298 @@
+'''
+The selectors (epoll/kqueue/select) backend of network.async_socket.
+
+Instead of a reading and a writing thread per connection, and a polling thread per listener,
+one reactor thread waits on every listener and connection at once, and only wakes up when one of them is ready.
+The sockets it gives out are AsyncSockets, with the same callbacks, so SmartPipe and everything on top of it work as they are.
+
+Use it through async_socket:
+    async_socket.set_backend(async_socket.BACKEND_SELECTOR)
+    async_socket.start_server(handler, host, port)
+
+The receive, close and error callbacks are all called on the reactor thread.
+They should not block - while one runs, nothing else is received or sent.
+(send_data() never blocks, so sending from a callback is fine)
+'''
+import collections
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+
+from network import async_socket
+from network import tracing
+from network.tracing import trace
+
+_RECV_SIZE = 1 << 16
+
+
+class Reactor:
+    '''
+    The event loop. Runs on its own thread, which is started when there is something to do,
+    and ends when there is nothing left registered.
+    Everything touching the selector runs on that thread - other threads go through call_soon().
+    '''
+    def __init__(self):
+        self._selector=selectors.DefaultSelector()
+        self._lock=threading.Lock()
+        self._calls=collections.deque()
+        self._timers=[]
+        self._timer_seq=itertools.count()
+        self._thread=None
+
+        # Writing a byte here wakes the thread up from select()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, self._drain_wakeups)
+
+    def call_soon(self, func):
+        '''
+        Call func() on the reactor thread. Thread safe. Calls run in the order they were made.
+        '''
+        with self._lock:
+            self._calls.append(func)
+            if self._thread is None:
+                self._thread=threading.Thread(target=self._run, name="selector reactor")
+                self._thread.start()
+                return
+        try:
+            self._wakeup_w.send(b"\0")
+        except BlockingIOError:
+            pass # Already plenty of wakeups pending
+
+    def call_later(self, delay, func):
+        '''
+        Call func() on the reactor thread after (delay) seconds. Only from the reactor thread.
+        '''
+        heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_seq), func))
+
+    def register(self, sock, events, handler):
+        # handler(mask) is called when sock is ready
+        self._selector.register(sock, events, handler)
+
+    def modify(self, sock, events, handler):
+        self._selector.modify(sock, events, handler)
+
+    def unregister(self, sock):
+        self._selector.unregister(sock)
+
+    def _drain_wakeups(self, mask):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _run(self):
+        while True:
+            with self._lock:
+                calls=self._calls
+                self._calls=collections.deque()
+            for func in calls:
+                self._call(func)
+
+            now=time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                self._call(heapq.heappop(self._timers)[2])
+
+            with self._lock:
+                if not self._calls and not self._timers and len(self._selector.get_map()) == 1:
+                    # Only the wakeup socket left: done until the next call_soon()
+                    self._thread=None
+                    return
+                if self._calls:
+                    continue
+
+            timeout=max(0, self._timers[0][0] - time.monotonic()) if self._timers else None
+            for key, mask in self._selector.select(timeout):
+                self._call(lambda: key.data(mask))
+
+    def _call(self, func):
+        try:
+            func()
+        except Exception as err:
+            # Never let one connection take the whole loop down
+            trace(tracing.ERROR, "\nError occurred in the reactor: {}", err)
+
+
+_reactor=Reactor()
+
+
+class SelectorSocket(async_socket.AsyncSocket):
+    '''
+    An AsyncSocket driven by the reactor, instead of threads of its own.
+    '''
+    def __init__(self, sock, addr, port, reactor=None):
+        super().__init__(sock, addr, port)
+        self._sock.setblocking(False)
+        self._reactor=reactor or _reactor
+        self._events=0
+        self._writing=False
+        self._closed=False
+
+    def _register(self):
+        # On the reactor thread
+        self._events=selectors.EVENT_READ
+        self._reactor.register(self._sock, self._events, self._on_ready)
+        if self._writing:
+            self._start_writing()
+
+    def _set_events(self, events):
+        if events != self._events:
+            self._events=events
+            self._reactor.modify(self._sock, events, self._on_ready)
+
+    def _on_ready(self, mask):
+        if mask & selectors.EVENT_READ:
+            self._on_readable()
+        if mask & selectors.EVENT_WRITE and not self._closed:
+            self._on_writable()
+
+    def _on_readable(self):
+        try:
+            data=self._sock.recv(_RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as err:
+            # ConnectionResetError and friends: the peer's gone
+            self._close(err)
+            return
+
+        if len(data) == 0:
+            # Orderly shutdown by the peer. Closed, but not an error - same as the threads backend
+            self._close()
+            return
+
+        self._call_recv_callbacks(data)
+
+    def _wake_writer(self):
+        # With _send_cond held, on any thread
+        if not self._writing:
+            self._writing=True
+            self._reactor.call_soon(self._start_writing)
+
+    def _start_writing(self):
+        # On the reactor thread. Try right away - usually the whole queue fits in the socket buffer
+        if self._closed or self._events == 0:
+            return # Closed, or not registered yet. _register() comes back here
+        self._on_writable()
+
+    def kill_socket(self):
+        # The queued data goes out first, as with the threads backend. But not forever
+        super().kill_socket()
+        self._reactor.call_soon(
+            lambda: self._reactor.call_later(async_socket.KILL_FLUSH_TIMEOUT, self._close)
+        )
+
+    def _on_writable(self):
+        with self._send_cond:
+            buffers=list(itertools.islice(self._send_queue, async_socket._MAX_BUFFERS_PER_SEND))
+
+        if buffers:
+            try:
+                sent=self._send_some(buffers)
+            except (BlockingIOError, InterruptedError):
+                sent=0
+            except OSError as err:
+                self._close(err)
+                return
+        else:
+            sent=0
+
+        with self._send_cond:
+            self._consume_sent(sent)
+            if self._send_queue:
+                # Wait for the peer to make room
+                self._set_events(selectors.EVENT_READ | selectors.EVENT_WRITE)
+                return
+            if self._alive:
+                self._writing=False
+                self._set_events(selectors.EVENT_READ)
+                return
+        # Killed, and everything is out
+        self._close()
+
+    def _close(self, err=None):
+        # On the reactor thread. err: the exception that killed the connection, if any
+        if self._closed:
+            return
+        self._closed=True
+        with self._send_cond:
+            self._alive=False
+            self._send_queue.clear()
+            self._send_queue_bytes=0
+        if self._events:
+            self._reactor.unregister(self._sock)
+            self._events=0
+        self._sock.close()
+        if err is not None:
+            trace(tracing.ERROR, '\nError occurred: {}', err)
+            self._call_error_callbacks(err)
+        trace(tracing.INFO, "Closing AsyncSocket")
+        self._call_close_callbacks()
+
+
+class _Listener:
+    def __init__(self, handler, host, port, reactor):
+        self._host=host
+        self._port=port
+        self._handler=handler
+        self._reactor=reactor
+
+        self._sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        trace(tracing.INFO, "\nBind to... {} {}", self._host, self._port)
+        self._sock.bind((self._host, self._port))
+        self._sock.listen()
+        self._sock.setblocking(False)
+
+    def _register(self):
+        self._reactor.register(self._sock, selectors.EVENT_READ, self._on_ready)
+
+    def _on_ready(self, mask):
+        while True:
+            try:
+                (client_sock, (ip, port)) = self._sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # Out of file descriptors, or the like. Try again on the next event
+                return
+            lc=SelectorSocket(client_sock, ip, port, self._reactor)
+            self._handler(lc)
+            lc._register()
+
+    def kill(self):
+        trace(tracing.INFO, "Killing... {} {}", self._host, self._port)
+
+        def close():
+            self._reactor.unregister(self._sock)
+            self._sock.close()
+            trace(tracing.INFO, "Killed {} {}", self._host, self._port)
+        self._reactor.call_soon(close)
+
+
+_listeners=dict()
+def start_server(new_connection_handler, host, port):
+    k=(host,port)
+    if k in _listeners:
+        raise Exception("You already have a handler there!")
+    listener=_Listener(new_connection_handler, host, port, _reactor)
+    _listeners[k]=listener
+    _reactor.call_soon(listener._register)
+
+def end_server(host,port):
+    if (host, port) in _listeners:
+        _listeners.pop((host, port)).kill()
+
+
+def initiate_connection(ip,port):
+    s=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((ip,port))
+
+    lc=SelectorSocket(s, ip, port, _reactor)
+    _reactor.call_soon(lc._register)
+    return lc
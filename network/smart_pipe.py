@@ -4,7 +4,14 @@ Adds various functionality on top of network.async_socket.AsyncSocket
 Please refer to the docstring of SmartPipe for details.
 '''
 
+import asyncio
+import inspect
+import struct
+import threading
+
 from network import async_socket
+from network import tracing
+from network.tracing import trace
 from util.utils import perline_prefix, extract_bit
 
 
@@ -28,13 +35,11 @@ class _SmartPipeFrame:
         Requst type.
     [11...? PAYLOAD (variable length)
     '''
-    _pos_flags = slice(0, 1)
     _pos_flags_response_expected_bit = 0
     _pos_flags_is_response_bit = 1
-    _pos_length = slice(1, 5)
-    _pos_request_id = slice(5, 9)
-    _pos_rqtype = slice(9, 11)
-    _header_length = 11
+    # FLAGS, LENGTH, REQUEST_ID, RQTYPE
+    _header = struct.Struct(">BIIH")
+    _header_length = _header.size
 
     def __init__(self, *, response_expected, is_response, length, request_id, rqtype, payload):
         '''
@@ -96,24 +101,26 @@ class _SmartPipeFrame:
         )
 
     @classmethod
-    def frame_unpack(cls, buffer:bytes):
+    def frame_unpack(cls, buffer, offset=0):
         '''
         bytes -> SmartPipeFrame
+        buffer: any bytes-like object. The frame is read starting at offset.
+        The payload is the only thing copied out of the buffer, exactly once.
+        returns: (frame, number of bytes the frame takes up in the buffer)
         '''
-        if len(buffer) < cls._header_length:
+        if len(buffer) - offset < cls._header_length:
             raise _IncompleteFrameException
 
-        flags = buffer[cls._pos_flags][0]
+        flags, length, request_id, rqtype = cls._header.unpack_from(buffer, offset)
         response_expected = extract_bit(flags, cls._pos_flags_response_expected_bit)
         is_response = extract_bit(flags, cls._pos_flags_is_response_bit)
-        length = int.from_bytes(buffer[cls._pos_length],"big")
-        request_id = int.from_bytes(buffer[cls._pos_request_id],"big")
-        rqtype = int.from_bytes(buffer[cls._pos_rqtype],"big")
 
-        if len(buffer) - cls._header_length < length:
+        if len(buffer) - offset - cls._header_length < length:
             raise _IncompleteFrameException
 
-        payload = buffer[cls._header_length:cls._header_length + length]
+        start = offset + cls._header_length
+        with memoryview(buffer) as view:
+            payload = bytes(view[start:start + length])
 
         spf= _SmartPipeFrame(
             response_expected=response_expected,
@@ -127,30 +134,43 @@ class _SmartPipeFrame:
         return spf,(cls._header_length + length)
 
     @classmethod
-    def frame_pack(cls, spf):
+    def frame_dump(cls, spf):
+        # For tracing: the formatted frame, only built when the message is recorded
+        return tracing.Lazy(lambda: perline_prefix(str(spf), " |"))
+
+    @classmethod
+    def frame_pack_parts(cls, spf):
         '''
-        SmartPipeFrame -> bytes
+        SmartPipeFrame -> (header bytes, payload)
+        Sending these back to back sends the frame, without copying the payload.
         '''
-        result=bytes()
-
         flags=0
         if spf.response_expected:
             flags |= 1 << cls._pos_flags_response_expected_bit
         if spf.is_response:
             flags |= 1 << cls._pos_flags_is_response_bit
 
-        result += bytes((flags,))
-        result+= int(spf.length).to_bytes(cls._pos_length.stop-cls._pos_length.start,"big")
-        result += int(spf.request_id).to_bytes(cls._pos_request_id.stop - cls._pos_request_id.start, "big")
-        result += int(spf.request_type).to_bytes(cls._pos_rqtype.stop - cls._pos_rqtype.start, "big")
-        result += spf.payload
+        return (
+            cls._header.pack(flags, spf.length, spf.request_id, spf.request_type),
+            spf.payload
+        )
 
-        return result
+    @classmethod
+    def frame_pack(cls, spf):
+        '''
+        SmartPipeFrame -> bytes
+        '''
+        # Joined once at the end, so the payload is copied only once
+        return b"".join(cls.frame_pack_parts(spf))
 
 
 class DeadPipeException(Exception):
     pass
 
+
+# The consumed part of a SmartPipe's receive buffer is cut off once it is this big
+_COMPACT_THRESHOLD = 1 << 16
+
 class SmartPipe():
     '''
     A intelligent data exchange mechanism, runs on top of AsyncSocket.
@@ -197,7 +217,13 @@ class SmartPipe():
         self._pending_callbacks = dict()
         self._handlers = dict()
 
-        self._buffer = bytes()
+        # Received data. Frames are parsed in place, starting at _buffer_cursor;
+        # the consumed part is only cut off once it gets big. (see _try_parse)
+        # The socket thread appends while the parser may be running on another thread,
+        # so both hold _buffer_lock.
+        self._buffer = bytearray()
+        self._buffer_cursor = 0
+        self._buffer_lock = threading.Lock()
 
         self._socket_close_handlers=[]
         self._raise_for_dead_socket=True
@@ -234,7 +260,8 @@ class SmartPipe():
 
     def _recv_handler(self, data):
 
-        self._buffer += data
+        with self._buffer_lock:
+            self._buffer += data
 
         self._callback_runner(lambda:self._parse_loop())
 
@@ -245,39 +272,57 @@ class SmartPipe():
 
     def _try_parse(self):
         # try to consume a frame
-        try:
-            spf,consumed=_SmartPipeFrame.frame_unpack(self._buffer)
-            self._buffer = self._buffer[consumed:]
-        except _IncompleteFrameException:
-            return False
-        print("\nSmartPipe received a complete frame.")
-        print(perline_prefix(str(spf)," |"))
+        with self._buffer_lock:
+            try:
+                spf,consumed=_SmartPipeFrame.frame_unpack(self._buffer, self._buffer_cursor)
+            except _IncompleteFrameException:
+                return False
+            self._buffer_cursor += consumed
+
+            if self._buffer_cursor == len(self._buffer):
+                # Everything consumed - start over, nothing to move
+                self._buffer.clear()
+                self._buffer_cursor = 0
+            elif self._buffer_cursor >= _COMPACT_THRESHOLD:
+                del self._buffer[:self._buffer_cursor]
+                self._buffer_cursor = 0
+        # One message per frame, so sampling keeps or drops the frame and its handler line together
+        trace(tracing.FRAMES, "\nSmartPipe received a complete frame.\n{}{}",
+              _SmartPipeFrame.frame_dump(spf), "" if spf.is_response else "\n > Handler called.",
+              rqtype=spf.request_type)
 
         if spf.is_response:
             self._pending_callbacks[spf.request_id](spf.payload)
             del self._pending_callbacks[spf.request_id]
         else:
-            print(" > Handler called.")
-            result = self._handlers[spf.request_type](spf.payload)
-            if spf.response_expected:
-                spf2=_SmartPipeFrame.frame_create(
-                    payload=result,
-                    response_expected=False,
-                    is_response=True,
-                    request_id=spf.request_id,
-                    request_type=spf.request_type
-                )
-                print("SmartPipe is sending a response.")
-                print(perline_prefix(str(spf2), " |"))
-                if self._as.alive:
-                    self._as.send_data(_SmartPipeFrame.frame_pack(spf2))
-                else:
-                    print("Socket is dead! not sending a response!")
+            self._handle_request(spf)
 
         return True
 
+    def _handle_request(self, spf):
+        # Call the handler of a received request, and respond if the sender wants a response
+        result = self._handlers[spf.request_type](spf.payload)
+        if spf.response_expected:
+            self._respond(spf, result)
+
+    def _respond(self, spf, result):
+        # Send result back, as the response to the request spf
+        spf2=_SmartPipeFrame.frame_create(
+            payload=result,
+            response_expected=False,
+            is_response=True,
+            request_id=spf.request_id,
+            request_type=spf.request_type
+        )
+        trace(tracing.FRAMES, "SmartPipe is sending a response.\n{}",
+              _SmartPipeFrame.frame_dump(spf2), rqtype=spf2.request_type)
+        if self._as.alive:
+            self._as.send_buffers(_SmartPipeFrame.frame_pack_parts(spf2))
+        else:
+            trace(tracing.INFO, "Socket is dead! not sending a response!")
+
     def kill_pipe(self):
-        print("\nKilling SmartPipe")
+        trace(tracing.INFO, "\nKilling SmartPipe")
         self._as.kill_socket()
 
     def send_request(self, data, rqtype=60000, callback_function=None):
@@ -310,16 +355,53 @@ class SmartPipe():
             request_type=rqtype
         )
 
-        print("\nSmartPipe is sending data.")
-        print(perline_prefix(str(spf), " |"))
+        trace(tracing.FRAMES, "\nSmartPipe is sending data.\n{}",
+              _SmartPipeFrame.frame_dump(spf), rqtype=rqtype)
 
         if callback_function is not None:
             self._pending_callbacks[self._current_req_num] = callback_function
 
-        self._as.send_data(_SmartPipeFrame.frame_pack(spf))
+        self._as.send_buffers(_SmartPipeFrame.frame_pack_parts(spf))
 
         return self._current_req_num
 
+    @classmethod
+    def pack_broadcast(cls, data, rqtype=60000):
+        '''
+        Pack a request that does not expect a response into a complete frame, once,
+        so the same frame can be sent over many pipes with send_packed().
+        Nobody ever responds to such a frame, so its request ID is never used. It is always 0.
+        returns: the packed frame (bytes)
+        '''
+        spf=_SmartPipeFrame.frame_create(
+            payload=data,
+            response_expected=False,
+            is_response=False,
+            request_id=0,
+            request_type=rqtype
+        )
+        return _SmartPipeFrame.frame_pack(spf)
+
+    def send_packed(self, frame):
+        '''
+        Send a frame created by pack_broadcast().
+        The frame is sent as is - nothing is encoded or copied per pipe.
+        '''
+        if not self._as.alive:
+            self._call_dead_pipe_listeners()
+
+            if self._raise_for_dead_socket:
+                raise DeadPipeException("This pipe is dead!")
+
+            return # no-op afterwards
+
+        if tracing.enabled(tracing.FRAMES):
+            spf,_=_SmartPipeFrame.frame_unpack(frame)
+            trace(tracing.FRAMES, "\nSmartPipe is sending a packed frame.\n{}",
+                  _SmartPipeFrame.frame_dump(spf), rqtype=spf.request_type)
+
+        self._as.send_data(frame)
+
     def cancel_callback(self, req_id):
         del self._pending_callbacks[req_id]
 
@@ -335,3 +417,80 @@ class SmartPipe():
         if rqtype < 1 or rqtype > 60000:
             raise Exception("rqtype must be in range [1..60000]")
         self._handlers[rqtype] = handler
+
+
+class AsyncSmartPipe(SmartPipe):
+    '''
+    SmartPipe for asyncio programs, on top of network.asyncio_socket.AsyncioSocket.
+    Differences from SmartPipe:
+     - send_request() returns an awaitable that resolves to the response, instead of taking a callback.
+           response = await pipe.send_request(data, rqtype)
+       If the pipe dies before the response arrives, awaiting it raises DeadPipeException.
+     - A handler may also be a coroutine function. It is run as a task for every request,
+       whether the sender wants a response or not, and its response (if wanted) is sent once it finishes.
+    Handlers and responses run on the event loop, so there is no callback runner.
+    '''
+    def __init__(self, asyncsocket):
+        super().__init__(asyncsocket)
+        self._pending_futures = dict()
+        # The event loop only keeps weak references to tasks
+        self._handler_tasks = set()
+        self._as.add_connection_close_callback(self._fail_pending_futures)
+
+    def send_request(self, data, rqtype=60000, *, expect_response=True):
+        '''
+        Send a request over the pipe. Must be called from the event loop.
+        data: a bytes() object
+        rqtype: the request type. should be an integer 1~60000
+                if not set, defaults to 60000
+        expect_response: (keyword only) if False, the receiver will not send a response, and None is returned.
+                         Keyword only, so that code written for SmartPipe.send_request(data, rqtype, callback)
+                         fails loudly instead of having its callback ignored.
+        returns: an awaitable, resolving to the response (bytes)
+        '''
+        if not expect_response:
+            super().send_request(data, rqtype)
+            return None
+
+        future = asyncio.get_running_loop().create_future()
+
+        def callback(response):
+            self._pending_futures.pop(req_id, None)
+            if not future.done(): # Might have been cancelled
+                future.set_result(response)
+
+        req_id = super().send_request(data, rqtype, callback)
+        if req_id is None:
+            # Dead pipe, with the exception disabled
+            future.set_exception(DeadPipeException("This pipe is dead!"))
+        else:
+            self._pending_futures[req_id] = future
+        return future
+
+    def _fail_pending_futures(self):
+        futures = self._pending_futures
+        self._pending_futures = dict()
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(DeadPipeException("This pipe died before the response arrived!"))
+
+    def _handle_request(self, spf):
+        result = self._handlers[spf.request_type](spf.payload)
+        if not inspect.isawaitable(result):
+            if spf.response_expected:
+                self._respond(spf, result)
+            return
+
+        def done(task):
+            self._handler_tasks.discard(task)
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                trace(tracing.ERROR, "\nHandler for request type {} failed: {}",
+                      spf.request_type, task.exception())
+                return
+            if spf.response_expected:
+                self._respond(spf, task.result())
+        task = asyncio.ensure_future(result)
+        self._handler_tasks.add(task)
+        task.add_done_callback(done)
@@ -0,0 +1,137 @@
+'''
+Tracing for the network layer.
+
+Everything the network layer used to print (connections, every frame, raw socket data)
+goes through trace() instead, and is only formatted and written out when it is actually recorded.
+Tracing is off by default, and can be reconfigured at any time, from any thread, without a restart:
+
+    tracing.configure(level=tracing.FRAMES)               # dump every frame
+    tracing.configure(request_types={113, 114})          # ...of these request types only
+    tracing.configure(sample_rate=0.01)                  # ...1 in 100 of them
+    tracing.configure(level=tracing.OFF)                 # and off again
+
+Levels, from least to most verbose:
+    OFF     nothing
+    ERROR   errors
+    INFO    connections opening and closing
+    FRAMES  every SmartPipe frame sent or received
+    RAW     every chunk of data sent or received on a socket
+
+Messages are str.format() templates, and their arguments are only formatted
+if the message passes the level, request type and sampling checks.
+Wrap anything expensive to build (not just to format) in Lazy.
+'''
+import random
+import signal
+import sys
+
+OFF = 0
+ERROR = 1
+INFO = 2
+FRAMES = 3
+RAW = 4
+
+_LEVEL_NAMES = {OFF: "OFF", ERROR: "ERROR", INFO: "INFO", FRAMES: "FRAMES", RAW: "RAW"}
+
+
+def _print_sink(message):
+    print(message, file=sys.stdout)
+
+
+class Lazy:
+    '''
+    Wraps a function, so that its result is only computed when the message is formatted.
+        trace(FRAMES, "{}", Lazy(lambda: perline_prefix(str(frame), " |")))
+    '''
+    __slots__ = ("_func",)
+
+    def __init__(self, func):
+        self._func = func
+
+    def __str__(self):
+        return str(self._func())
+
+    def __format__(self, spec):
+        return format(self._func(), spec)
+
+
+class _Config:
+    # Replaced as a whole on every change, so readers on other threads always see a consistent set
+    __slots__ = ("level", "request_types", "sample_rate", "sink")
+
+    def __init__(self, level, request_types, sample_rate, sink):
+        self.level = level
+        self.request_types = request_types
+        self.sample_rate = sample_rate
+        self.sink = sink
+
+
+_config = _Config(OFF, None, 1.0, _print_sink)
+
+
+def configure(level=None, request_types=(), sample_rate=None, sink=None):
+    '''
+    Change any of the tracing settings. Arguments left out are not changed.
+    level:         one of OFF, ERROR, INFO, FRAMES, RAW
+    request_types: iterable of the request types whose frames are traced, or None for all of them
+    sample_rate:   fraction (0~1) of the FRAMES and RAW messages that are recorded
+    sink:          function taking the formatted message (str). Prints to stdout by default.
+    '''
+    global _config
+    old = _config
+    _config = _Config(
+        old.level if level is None else level,
+        old.request_types if request_types == () else
+        (None if request_types is None else frozenset(request_types)),
+        old.sample_rate if sample_rate is None else sample_rate,
+        old.sink if sink is None else sink
+    )
+
+
+def level():
+    return _config.level
+
+
+def enabled(msg_level, rqtype=None):
+    '''
+    Would a message of this level (and request type) be recorded, sampling aside?
+    Cheap - check this before building anything expensive.
+    '''
+    config = _config
+    if msg_level > config.level:
+        return False
+    if rqtype is not None and config.request_types is not None and rqtype not in config.request_types:
+        return False
+    return True
+
+
+def trace(msg_level, message, *args, rqtype=None):
+    '''
+    Record a message, if tracing is enabled for its level and request type.
+    message is formatted with args (str.format) only if it is recorded.
+    FRAMES and RAW messages are also subject to the sample rate.
+    '''
+    config = _config
+    if msg_level > config.level:
+        return
+    if rqtype is not None and config.request_types is not None and rqtype not in config.request_types:
+        return
+    if msg_level >= FRAMES and config.sample_rate < 1.0 and random.random() >= config.sample_rate:
+        return
+    config.sink(message.format(*args) if args else message)
+
+
+def install_signal_toggle():
+    '''
+    Let the process cycle through the trace levels with SIGUSR1,
+    e.g. `kill -USR1 <pid>` on a running server.
+    Only on platforms that have SIGUSR1, and only from the main thread.
+    '''
+    if not hasattr(signal, "SIGUSR1"):
+        return
+
+    def handler(signum, frame):
+        configure(level=(_config.level + 1) % (RAW + 1))
+        _print_sink("Network trace level: {}".format(_LEVEL_NAMES[_config.level]))
+
+    signal.signal(signal.SIGUSR1, handler)
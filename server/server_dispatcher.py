@@ -1,4 +1,7 @@
+import asyncio
 from network import async_socket
+from network import asyncio_socket
+from network import tracing
 from api import server_api
 from server import server_logic
 import time
@@ -12,6 +15,9 @@ def incoming_connection_handler(dt):
     #serverconnections.append(serverconnection)
 
 def start_server(host='', port=19477):
+    # Network tracing is off by default - `kill -USR1` the server to cycle through the levels
+    tracing.install_signal_toggle()
+
     async_socket.start_server(
         incoming_connection_handler,
         host,
@@ -23,4 +29,30 @@ def start_server(host='', port=19477):
     except KeyboardInterrupt:
         print("\n^C received - killing all connections")
         gamelogic.kill_all_connections()
-        async_socket.end_server(host,port)
\ No newline at end of file
+        async_socket.end_server(host,port)
+
+
+async def _serve_asyncio(host, port):
+    server = await asyncio_socket.start_server(
+        incoming_connection_handler,
+        host,
+        port
+    )
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        # asyncio.run() cancels us on ^C
+        print("\n^C received - killing all connections")
+        gamelogic.kill_all_connections()
+        raise
+
+def start_server_asyncio(host='', port=19477):
+    '''
+    start_server(), on an asyncio event loop instead of threads.
+    '''
+    tracing.install_signal_toggle()
+    try:
+        asyncio.run(_serve_asyncio(host, port))
+    except KeyboardInterrupt:
+        pass
@@ -1,8 +1,10 @@
-from common import mines
 from api import server_api
+import collections
 import enum
 from api import api_datatypes
-from common import mines
+from common import packed_mines
+from common import snapshot
+from common import tiled_mines
 
 class PlayerState(enum.Enum):
     LOBBY=1
@@ -22,12 +24,18 @@ class PlayerSlotState(enum.Enum):
     LEFT=72
 
 class GameInstance:
-    def __init__(self, room_id, name, dimensions, mine_prob, max_players):
+    # Lockstep rooms send the state hash with every this many inputs
+    LOCKSTEP_HASH_INTERVAL=16
+    # Number of recent states kept, to repair clients that fell behind with a delta
+    REPAIR_HISTORY=32
+
+    def __init__(self, room_id, name, dimensions, mine_prob, max_players, lockstep=False):
         self._room_id=room_id
         self._name=name
         self._dimensions=dimensions
         self._mine_prob=mine_prob
         self._max_players=max_players
+        self._lockstep=lockstep
         self._player_count=0
         self._active=False
         self._started=False
@@ -40,10 +48,19 @@ class GameInstance:
         for i in range(1,self._max_players+1):
             self._player_slot_state[i]=PlayerSlotState.NOT_JOINED
 
-        self._mfs=mines.MineFieldGenerator.generate_symmetrical_deterministic(dimensions[0],
-                                                                dimensions[1],
-                                                                mine_prob/100,
-                                                                max_players)
+        if dimensions[0]*dimensions[1] >= tiled_mines.TILED_BOARD_MIN_CELLS:
+            # Huge board - generate tiles as they are touched, so creating the room only looks at the edges
+            self._mfs=tiled_mines.TiledMineFieldGenerator.generate_symmetrical(dimensions[0],
+                                                                             dimensions[1],
+                                                                             mine_prob/100,
+                                                                             max_players)
+        else:
+            self._mfs=packed_mines.PackedMineFieldGenerator.generate_symmetrical_deterministic(dimensions[0],
+                                                                                    dimensions[1],
+                                                                                    mine_prob/100,
+                                                                                    max_players)
+
+        self._history=collections.deque((self._mfs,),maxlen=self.REPAIR_HISTORY)
 
         self._explode_listeners=[]
 
@@ -66,10 +83,26 @@ class GameInstance:
 
     def add_input(self, rmfi:api_datatypes.RoomMFI):
         mfi=api_datatypes.mfi_extract(rmfi)
-        self._mfs=self._mfs.process_input(mfi)
-
+        mfs,changes=self._mfs.process_input(mfi, return_changes=True)
+        self._mfs=mfs
+        self._history.append(mfs)
+
+        # Encode once, send the same frame to everyone
+        if self._lockstep:
+            # Only the input - the clients apply it themselves, and check their hash every few inputs
+            state_hash=None
+            if mfs.version % self.LOCKSTEP_HASH_INTERVAL == 0:
+                state_hash=mfs.state_hash()
+            frame=server_api.ServerSideAPI.pack_input_broadcast(rmfi, mfs.version, state_hash)
+        else:
+            # Only the changed cells
+            frame=server_api.ServerSideAPI.pack_newstate_delta(rmfi,
+                                                               mfs.version-1,
+                                                               mfs.version,
+                                                               changes,
+                                                               mfs.cell_bytes(changes))
         for player in self._players:
-            player.connection.send_newstateACK(rmfi, self._mfs)
+            player.connection.send_packed(frame)
 
         self.check_end_condition()
     def check_end_condition(self):
@@ -161,11 +194,38 @@ class GameInstance:
     @property
     def mfs(self):
         return self._mfs
+    def state_hash(self):
+        return self._mfs.state_hash()
+
+    def send_state(self, player, version=None, state_hash=None):
+        '''
+        Bring a player's state up to date, as cheaply as possible.
+        version, state_hash: the version and state_hash() of the player's current state, if it has one.
+          - Same as ours: just tell the player it is in sync.
+          - Same as one of our recent states: send the cells that changed since then.
+          - Otherwise: send the whole state.
+        '''
+        mfs=self._mfs
+        rmfi=api_datatypes.RoomMFI(0,0,0,0,0,self._room_id)
+
+        if version is not None and state_hash is not None:
+            if version==mfs.version and state_hash==mfs.state_hash():
+                player.connection.send_in_sync(self._room_id, version)
+                return
+            for old in self._history:
+                if old.version==version and old.state_hash()==state_hash:
+                    changes=mfs.changed_indices(old)
+                    player.connection.send_newstate_delta(rmfi, version, mfs.version,
+                                                          changes, mfs.cell_bytes(changes))
+                    return
+
+        player.connection.send_newstateACK(rmfi, mfs)
 
     def to_game_room_data(self):
         return api_datatypes.GameRoomData(
             name=self._name,
-            parameters="{}x{}@{:.03f}%".format(self._dimensions[0],self._dimensions[1],self._mine_prob),
+            parameters="{}x{}@{:.03f}%{}".format(self._dimensions[0],self._dimensions[1],self._mine_prob,
+                                                 " (lockstep)" if self._lockstep else ""),
             room_id=self._room_id,
             current_players=self._player_count,
             max_players=self._max_players,
@@ -285,6 +345,9 @@ class ServerSideGameLogic():
         return result
 
     def _handle_game_creation(self, rcp:api_datatypes.RoomCreationParameters):
+        if rcp.field_size_x > snapshot.MAX_DIMENSION or rcp.field_size_y > snapshot.MAX_DIMENSION:
+            # Neither the snapshots nor MineFieldState.to_bytes() could send the field
+            raise server_api.InvalidRequestException("Field too big! At most {} cells on a side".format(snapshot.MAX_DIMENSION))
         self._game_id_base+=1
         game_id=self._game_id_base
         gi=GameInstance(
@@ -292,7 +355,8 @@ class ServerSideGameLogic():
                 rcp.name,
                 (rcp.field_size_x,rcp.field_size_y),
                 rcp.mine_prob,
-                rcp.max_players
+                rcp.max_players,
+                rcp.lockstep
             )
 
         self._game_list[game_id]=gi
@@ -328,14 +392,12 @@ class ServerSideGameLogic():
         room=self._game_list[room_id]
         return room.to_ingame_room_data()
 
-    def _handle_explicit_newstate_request(self,player_id):
+    def _handle_explicit_newstate_request(self,player_id,version=None,state_hash=None):
         self._validate_player_id(player_id)
         player=self._user_list[player_id]
 
         room=self.find_game_with_user(player)
-        player.connection.send_newstateACK(
-            api_datatypes.RoomMFI(0,0,0,0,0,room.room_id),
-            room.mfs)
+        room.send_state(player, version, state_hash)
 
     def _handle_leave_room(self, player_id):
         self._validate_player_id(player_id)
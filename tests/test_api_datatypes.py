@@ -0,0 +1,28 @@
+import unittest
+
+from api import api_datatypes
+
+
+class DictToNamedtupleTest(unittest.TestCase):
+    def test_room_creation_without_lockstep(self):
+        # CREATE_GAME from a client that predates lockstep rooms
+        rcp=api_datatypes.dict_to_namedtuple(
+            {"name": "room", "field_size_x": 30, "field_size_y": 20, "mine_prob": 0.15, "max_players": 4},
+            api_datatypes.RoomCreationParameters)
+        self.assertEqual(rcp.lockstep, False)
+        self.assertEqual(rcp.field_size_x, 30)
+
+    def test_room_creation_with_lockstep(self):
+        d={"name": "room", "field_size_x": 30, "field_size_y": 20, "mine_prob": 0.15, "max_players": 4,
+           "lockstep": True}
+        rcp=api_datatypes.dict_to_namedtuple(d, api_datatypes.RoomCreationParameters)
+        self.assertEqual(rcp.lockstep, True)
+        self.assertEqual(api_datatypes.namedtuple_to_dict(rcp), d)
+
+    def test_required_field_missing(self):
+        with self.assertRaises(KeyError):
+            api_datatypes.dict_to_namedtuple({"name": "room"}, api_datatypes.RoomCreationParameters)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,4 @@
+import functools
 import itertools
 
 
@@ -12,6 +13,94 @@ class InvalidCoordinatesException(Exception):
     pass
 
 
+class NeighborTable:
+    '''
+    Neighbor indices for an array of the given dimensions. Get one with neighbor_table().
+    table[index] is a tuple of the flat indices (see MultiDimArray.coords_to_index) of every in-bounds neighbor of that cell,
+    diagonals included, ordered like itertools.product((-1,0,1), repeat=len(dimensions)) orders the deltas.
+
+    Nothing is stored per cell: which neighbors are in bounds only depends on whether each coordinate
+    is on the low edge, inside or on the high edge, so the flat offsets are kept once per combination of those,
+    and added to the index on lookup. The whole table takes memory proportional to the sum of the dimensions.
+    '''
+    def __init__(self, dimensions):
+        dimensions = tuple(dimensions)
+        self._length = _multiply_all_elements(dimensions)
+
+        strides = []
+        stride = 1
+        for size in reversed(dimensions):
+            strides.append(stride)
+            stride *= size
+        strides.reverse()
+
+        # Per dimension: the distinct sets of valid deltas, and which one each coordinate uses
+        class_deltas = []
+        class_ids = []
+        for size in dimensions:
+            deltas = []
+            ids = []
+            for c in range(size):
+                valid = tuple(d for d in (-1, 0, 1) if 0 <= c + d < size)
+                if valid not in deltas:
+                    deltas.append(valid)
+                ids.append(deltas.index(valid))
+            class_deltas.append(deltas)
+            class_ids.append(bytes(ids))
+
+        # Flat offsets of the neighbors, for every combination of classes.
+        # Combinations are numbered like the coordinates: the last dimension changes fastest.
+        self._offsets = [
+            tuple(
+                sum(d * strides[i] for i, d in enumerate(delta))
+                for delta in itertools.product(*edge_type)
+                if any(delta))
+            for edge_type in itertools.product(*class_deltas)
+        ]
+
+        # (stride, class ids, number of classes) of each dimension
+        self._dims = tuple(zip(strides, class_ids, (len(i) for i in class_deltas)))
+        if len(dimensions) == 2:
+            self._size_y = dimensions[1]
+            self._class_x, self._class_y = class_ids
+            self._classes_y = len(class_deltas[1])
+        else:
+            self._size_y = None
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._length:
+            raise IndexError("Neighbor table index out of range")
+        if self._size_y is not None:
+            x, y = divmod(index, self._size_y)
+            offsets = self._offsets[self._class_x[x] * self._classes_y + self._class_y[y]]
+        else:
+            key = 0
+            rest = index
+            for stride, ids, count in self._dims:
+                c, rest = divmod(rest, stride)
+                key = key * count + ids[c]
+            offsets = self._offsets[key]
+        return tuple([index + offset for offset in offsets])
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield self[index]
+
+
+@functools.lru_cache(maxsize=16)
+def neighbor_table(dimensions):
+    '''
+    The NeighborTable of an array of the given dimensions. (dimensions: a tuple)
+    Tables are cached, so every array of the same dimensions shares one.
+    A table is only as big as the sum of its dimensions, so the cache stays small
+    no matter how many cells the cached arrays have.
+    '''
+    return NeighborTable(dimensions)
+
+
 class MultiDimArray:
     '''
     Multi Dimensional Array
@@ -67,6 +156,31 @@ class MultiDimArray:
                 return False
         return True
 
+    def neighbor_table(self):
+        '''
+        The shared neighbor_table() for the dimensions of this array.
+        '''
+        return neighbor_table(self._dimensions)
+
+    def coords_to_index(self, coords):
+        return self._coord_to_index(coords)
+
+    def index_to_coords(self, index):
+        coords = []
+        for size in reversed(self._dimensions):
+            index, c = divmod(index, size)
+            coords.append(c)
+        return tuple(reversed(coords))
+
+    def get_flat(self, index):
+        '''
+        Access by flat index, in the same order as indices()
+        '''
+        return self._data[index]
+
+    def set_flat(self, index, value):
+        self._data[index] = value
+
     def _coord_to_index(self, coords):
         # Coordinates to index
         # A bit computationally-intensive, considering this will be called on every access to the array